@@ -1,5 +1,8 @@
+import os
 import socket
+import stat
 
+from tornado import netutil
 from tornado.platform.auto import set_close_exec
 
 
@@ -35,3 +38,68 @@ class Address(object):
                 sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
 
         return sock
+
+    def bind_sockets(self, backlog=128):
+        """\
+        Returns the listening sockets of the port, on every interface.
+        """
+
+        return netutil.bind_sockets(self._port, backlog=backlog)
+
+
+class UnixAddress(object):
+    """\
+    The class to represent the RPC address of a Unix domain socket.
+
+    A path which starts with '\\0' (or '@', for readability) is in the
+    abstract namespace of Linux and has no file.
+    """
+
+    def __init__(self, path):
+        if path.startswith('@'):
+            path = '\0' + path[1:]
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def abstract(self):
+        return self._path.startswith('\0')
+
+    def unpack(self):
+        return self._path
+
+    def socket(self, family=socket.AF_UNIX):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        set_close_exec(sock.fileno())
+        sock.setblocking(0)
+        return sock
+
+    def bind_sockets(self, backlog=128):
+        """\
+        Returns the listening socket of the path.  A stale socket file is
+        replaced; any other file is an error.
+        """
+
+        if not self.abstract:
+            return [netutil.bind_unix_socket(self._path, backlog=backlog)]
+
+        sock = self.socket()
+        sock.bind(self._path)
+        sock.listen(backlog)
+        return [sock]
+
+    def unlink(self):
+        """\
+        Removes the socket file, if any.
+        """
+
+        if self.abstract:
+            return
+        try:
+            if stat.S_ISSOCK(os.stat(self._path).st_mode):
+                os.remove(self._path)
+        except OSError:
+            pass
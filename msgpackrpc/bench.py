@@ -0,0 +1,270 @@
+"""\
+Benchmark suite.
+
+    % python -m msgpackrpc.bench [--transports tcp,asyncio,pool] [--concurrency 1,4]
+                                 [--payloads 0,1024,1048576] [--depths 1,32]
+                                 [--duration 1.0] [--output result.json]
+                                 [--baseline old.json [--tolerance 0.1]]
+
+Starts a server process on loopback, then for every combination of transport,
+concurrency (number of client processes, one connection each), payload size
+in bytes (0 calls sum(1, 2), others echo a binary of that size) and pipelining
+depth (requests in flight per client), runs the clients for `duration`
+seconds and reports the throughput and the p50/p99/p999 latency as JSON.
+
+With --baseline, the throughput of each run is compared with the same run of
+a previous report, and the exit status is 1 if any run got slower by more
+than `tolerance`.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import socket
+import sys
+import time
+
+import msgpackrpc
+from msgpackrpc import error
+
+
+TRANSPORTS = ('tcp', 'asyncio', 'pool')
+
+
+class BenchServer(object):
+    def sum(self, x, y):
+        return x + y
+
+    def echo(self, data):
+        return data
+
+
+def builder(name):
+    """\
+    Returns the builder of the transport called name.
+    """
+
+    if name == 'tcp':
+        from msgpackrpc.transport import tcp
+        return tcp
+    if name == 'asyncio':
+        from msgpackrpc.transport import asyncio as asyncio_transport
+        return asyncio_transport
+    if name == 'pool':
+        from msgpackrpc.transport import pool
+        return pool.Builder(size=4)
+    raise ValueError("Unknown transport: {0}".format(name))
+
+
+def percentile(samples, p):
+    """\
+    Returns the nearest-rank percentile p (0-100) of the sorted samples.
+    """
+
+    if not samples:
+        return None
+    rank = int(len(samples) * p / 100.0 + 0.5)
+    return samples[min(max(rank, 1), len(samples)) - 1]
+
+
+def _unused_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _serve(transport, port, ready):
+    server = msgpackrpc.Server(BenchServer(), builder=builder(transport))
+    server.listen(msgpackrpc.Address('127.0.0.1', port))
+    ready.set()
+    server.start()
+
+
+def _request(payload):
+    if payload == 0:
+        return 'sum', (1, 2)
+    return 'echo', (b'x' * payload,)
+
+
+def _run_client(args):
+    """\
+    Keeps depth requests in flight from start_at until duration seconds later.
+    Returns (latencies, errors, finished time).
+    """
+
+    transport, port, payload, depth, start_at, duration, timeout = args
+    client = msgpackrpc.Client(msgpackrpc.Address('127.0.0.1', port), timeout=timeout,
+                               builder=builder(transport))
+    method, params = _request(payload)
+    client.call(method, *params)   # connect and warm up
+
+    latencies = []
+    state = {'errors': 0, 'in_flight': 0}
+    deadline = start_at + duration
+
+    def send():
+        state['in_flight'] += 1
+        sent = time.time()
+        client.call_async(method, *params).add_done_callback(lambda f: done(f, sent))
+
+    def done(future, sent):
+        now = time.time()
+        state['in_flight'] -= 1
+        if future.error is not None:
+            state['errors'] += 1
+        else:
+            latencies.append(now - sent)
+
+        if now < deadline:
+            send()
+        elif state['in_flight'] == 0:
+            client._loop.stop()
+
+    time.sleep(max(0, start_at - time.time()))
+    for _ in range(depth):
+        send()
+    client._loop.start()
+    finished = time.time()
+    client.close()
+    return latencies, state['errors'], finished
+
+
+def run(transport, port, concurrency, payload, depth, duration, timeout=30):
+    """\
+    Runs one benchmark against the server on port and returns its report.
+    """
+
+    start_at = time.time() + 0.5 + 0.05 * concurrency
+    args = (transport, port, payload, depth, start_at, duration, timeout)
+    pool = multiprocessing.Pool(concurrency)
+    try:
+        results = pool.map(_run_client, [args] * concurrency)
+    finally:
+        pool.close()
+        pool.join()
+
+    latencies = sorted(itertools.chain.from_iterable(r[0] for r in results))
+    elapsed = max(r[2] for r in results) - start_at
+    return {
+        'transport': transport,
+        'concurrency': concurrency,
+        'payload': payload,
+        'depth': depth,
+        'requests': len(latencies),
+        'errors': sum(r[1] for r in results),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'latency_ms': dict((name, None if value is None else value * 1000)
+                           for name, value in (('p50', percentile(latencies, 50)),
+                                               ('p99', percentile(latencies, 99)),
+                                               ('p999', percentile(latencies, 99.9)),
+                                               ('max', latencies[-1] if latencies else None))),
+    }
+
+
+def sweep(transports, concurrencies, payloads, depths, duration, timeout=30, log=None):
+    """\
+    Runs every combination of the parameters, one server process per transport.
+    """
+
+    results = []
+    for transport in transports:
+        port = _unused_port()
+        ready = multiprocessing.Event()
+        server = multiprocessing.Process(target=_serve, args=(transport, port, ready))
+        server.daemon = True
+        server.start()
+        try:
+            if not ready.wait(10):
+                raise error.TransportError("Benchmark server did not start")
+            for concurrency, payload, depth in itertools.product(concurrencies, payloads, depths):
+                result = run(transport, port, concurrency, payload, depth, duration, timeout)
+                if log is not None:
+                    log.write("{transport} concurrency={concurrency} payload={payload} depth={depth}: "
+                              "{throughput:.0f} req/s, p99 {p99:.3f} ms\n".format(
+                                  p99=result['latency_ms']['p99'] or 0, **result))
+                results.append(result)
+        finally:
+            server.terminate()
+            server.join()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """\
+    Returns the (result, baseline result) pairs whose throughput dropped by
+    more than tolerance (a ratio).
+    """
+
+    def key(result):
+        return (result['transport'], result['concurrency'], result['payload'], result['depth'])
+
+    previous = dict((key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in results:
+        old = previous.get(key(result))
+        if old is not None and result['throughput'] < old['throughput'] * (1 - tolerance):
+            regressions.append((result, old))
+    return regressions
+
+
+def _ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m msgpackrpc.bench', description="MessagePack RPC benchmark")
+    parser.add_argument('--transports', default=','.join(TRANSPORTS))
+    parser.add_argument('--concurrency', type=_ints, default=[1, 4])
+    parser.add_argument('--payloads', type=_ints, default=[0, 1024, 1024 * 1024])
+    parser.add_argument('--depths', type=_ints, default=[1, 32])
+    parser.add_argument('--duration', type=float, default=1.0)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--output', help="write the report to this file instead of stdout")
+    parser.add_argument('--baseline', help="report of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    options = parser.parse_args(argv)
+
+    transports = options.transports.split(',')
+    for transport in transports:
+        try:
+            builder(transport)
+        except (ImportError, SyntaxError) as e:
+            parser.error("transport {0} is not available: {1}".format(transport, e))
+        except ValueError as e:
+            parser.error(str(e))
+
+    results = sweep(transports, options.concurrency, options.payloads, options.depths,
+                    options.duration, options.timeout, log=sys.stderr)
+    report = {
+        'version': msgpackrpc.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'duration': options.duration,
+        'results': results,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if options.baseline:
+        with open(options.baseline) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for result, old in regressions:
+            sys.stderr.write("regression: {transport} concurrency={concurrency} payload={payload} depth={depth}: "
+                             "{throughput:.0f} req/s, was {old:.0f}\n".format(old=old['throughput'], **result))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,201 @@
+"""\
+Cache of the results of idempotent methods.
+
+Pass a ResultCache as cache= to Client or Server; only the methods it lists
+are cached, keyed by the method and its packed arguments.  On the client a
+hit returns a resolved Future without sending the request; on the server a
+hit responds without calling the method.  Concurrent calls with the same key
+wait for the one in flight instead of being sent (or run) again.  Errors are
+never cached.
+
+Entries expire after their TTL and the least recently used ones are evicted
+to keep the packed results within max_bytes.  Results are stored packed, so
+every hit gets its own copy.  One ResultCache serves one Client or Server,
+on the thread of its loop.
+"""
+
+from collections import OrderedDict
+import time
+
+import msgpack
+
+from msgpackrpc import serializer
+from msgpackrpc.compat import force_str, iteritems
+
+
+# States of fetch()
+HIT = 'hit'
+PENDING = 'pending'
+MISS = 'miss'
+
+
+class ResultCache(object):
+    def __init__(self, methods, ttl=None, max_bytes=64 * 1024 * 1024, registry=serializer.REGISTRY):
+        """\
+        :param methods:   names of the cached methods, or a dict of name -> TTL
+                          (None for the default TTL).
+        :param ttl:       default seconds an entry lives, or None to keep it until evicted.
+        :param max_bytes: bound of the packed keys and results held.
+        :param registry:  serializer.Registry of the extension types in arguments and results.
+        """
+
+        if isinstance(methods, dict):
+            self._ttls = dict((force_str(name), ttl if value is None else value) for name, value in iteritems(methods))
+        else:
+            self._ttls = dict((force_str(name), ttl) for name in methods)
+        self._max_bytes = max_bytes
+        self._registry = registry
+        self._entries = OrderedDict()   # key -> (packed result, size, expiry)
+        self._pending = {}              # key -> callbacks waiting for the call in flight
+        self._stale = set()             # keys invalidated while their call was in flight
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0, 'expirations': 0}
+        self._metrics = None
+        self._side = None
+
+    def _bind(self, metrics, side):
+        # Called by the Client or Server which owns the cache
+        self._metrics = metrics
+        self._side = side
+
+    def key(self, method, args):
+        """\
+        Returns the key of the call, or None if it is not cached.
+        """
+
+        method = force_str(method)
+        if method not in self._ttls:
+            return None
+        try:
+            return (method, msgpack.packb(list(args), use_bin_type=True, default=self._registry.default))
+        except Exception:
+            return None
+
+    def fetch(self, key):
+        """\
+        Returns (HIT, result), (PENDING, None) if an identical call is in flight
+        (wait() for it), or (MISS, None).  After a miss, the caller makes the
+        call and passes its outcome to complete().
+        """
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            packed, size, expiry = entry
+            if expiry is None or expiry > time.time():
+                # Most recently used last
+                del self._entries[key]
+                self._entries[key] = entry
+                self._count('hits', key)
+                return HIT, self._unpack(packed)
+            self._remove(key)
+            self._stats['expirations'] += 1
+
+        if key in self._pending:
+            self._count('coalesced', key)
+            return PENDING, None
+
+        self._pending[key] = []
+        self._count('misses', key)
+        return MISS, None
+
+    def wait(self, key, callback):
+        """\
+        Calls callback(result, error) once the call in flight for key completes.
+        """
+
+        self._pending[key].append(callback)
+
+    def complete(self, key, result, error=None):
+        waiters = self._pending.pop(key, None)
+        stale = key in self._stale
+        self._stale.discard(key)
+        packed = None
+        if error is None:
+            try:
+                packed = msgpack.packb(result, use_bin_type=True, default=self._registry.default)
+            except Exception:
+                pass
+            else:
+                if not stale:
+                    self._store(key, packed)
+
+        for callback in waiters or ():
+            if packed is not None:
+                callback(self._unpack(packed), None)
+            else:
+                callback(result, error)
+
+    def invalidate(self, method, *args):
+        """\
+        Drops the entry of the call method(*args), or every entry of method if
+        no arguments are given.
+        """
+
+        if args:
+            keys = [self.key(method, args)]
+        else:
+            method = force_str(method)
+            keys = [key for key in self._entries if key[0] == method]
+            keys.extend(key for key in self._pending if key[0] == method)
+
+        for key in keys:
+            if key in self._entries:
+                self._remove(key)
+            if key in self._pending:
+                # The result of the call in flight may be older than the invalidation
+                self._stale.add(key)
+
+    def clear(self):
+        self._stale.update(self._pending)
+        self._entries.clear()
+        self._bytes = 0
+        self._gauge()
+
+    def stats(self):
+        """\
+        Returns the counters of hits, misses, coalesced calls, evictions and
+        expirations, the entries and bytes held, and the hit rate: the share
+        of the lookups served without a call of their own.
+        """
+
+        stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+        stats['hit_rate'] = float(stats['hits'] + stats['coalesced']) / lookups if lookups else 0.0
+        stats['entries'] = len(self._entries)
+        stats['bytes'] = self._bytes
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _store(self, key, packed):
+        size = len(key[0]) + len(key[1]) + len(packed)
+        if size > self._max_bytes:
+            return
+
+        if key in self._entries:
+            self._remove(key)
+        while self._bytes + size > self._max_bytes:
+            self._remove(next(iter(self._entries)))
+            self._stats['evictions'] += 1
+
+        ttl = self._ttls[key[0]]
+        self._entries[key] = (packed, size, None if ttl is None else time.time() + ttl)
+        self._bytes += size
+        self._gauge()
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[1]
+        self._gauge()
+
+    def _unpack(self, packed):
+        return msgpack.unpackb(packed, raw=False, ext_hook=self._registry.ext_hook)
+
+    def _count(self, name, key):
+        self._stats[name] += 1
+        if self._metrics is not None:
+            self._metrics.inc('cache_' + name, side=self._side, method=key[0])
+
+    def _gauge(self):
+        if self._metrics is not None:
+            self._metrics.set_gauge('cache_bytes', self._bytes, side=self._side)
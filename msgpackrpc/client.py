@@ -1,5 +1,15 @@
+from collections import deque
+import threading
+
+try:
+    from concurrent import futures as _futures
+except ImportError:
+    # Python 2 without the futures backport
+    _futures = None
+
 from msgpackrpc import Loop
 from msgpackrpc import session
+from msgpackrpc.error import TransportError
 from msgpackrpc.transport import tcp
 
 class Client(session.Session):
@@ -7,12 +17,15 @@ class Client(session.Session):
     Client is usaful for MessagePack RPC API.
     """
 
-    def __init__(self, address, timeout=10, loop=None, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None):
-        loop = loop or Loop()
-        session.Session.__init__(self, address, timeout, loop, builder, reconnect_limit, pack_encoding, unpack_encoding)
+    def __init__(self, address, timeout=10, loop=None, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None,
+                 metrics=None, max_outstanding=None, admission=session.BLOCK, compression=None, compress_threshold=1024,
+                 serializers=None, cache=None):
+        loop = loop or getattr(builder, 'Loop', Loop)()
+        session.Session.__init__(self, address, timeout, loop, builder, reconnect_limit, pack_encoding, unpack_encoding,
+                                 metrics, max_outstanding, admission, compression, compress_threshold, serializers, cache)
 
-        if timeout:
-            loop.attach_periodic_callback(self.step_timeout, 1000) # each 1s
+        # per-call timeouts may be given even if the default timeout is disabled
+        loop.attach_periodic_callback(self.step_timeout, self._timer.tick * 1000)
 
     @classmethod
     def open(cls, *args):
@@ -37,3 +50,110 @@ class Client(session.Session):
             if type:
                 return False
             return True
+
+
+class ThreadSafeClient(object):
+    """\
+    Client which may be shared by threads.
+
+    A background thread owns the loop and one Client, so every thread calls
+    over the same connection.  Calls are queued on a deque and picked up by
+    the loop thread in batches; call_async returns a concurrent.futures.Future.
+    The arguments are those of Client, except loop.
+    """
+
+    def __init__(self, address, **options):
+        if _futures is None:
+            raise NotImplementedError("ThreadSafeClient requires concurrent.futures")
+
+        self._client = Client(address, **options)
+        self._loop = self._client._loop
+        self._queue = deque()
+        self._scheduled = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='msgpackrpc-io')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def call(self, method, *args, **options):
+        """\
+        Calls method and waits for the result.
+        Pass timeout=seconds to override the default timeout of the client.
+        """
+
+        return self.call_async(method, *args, **options).result()
+
+    def call_async(self, method, *args, **options):
+        """\
+        Calls method and returns the concurrent.futures.Future of the result.
+        """
+
+        future = _futures.Future()
+        self._submit((method, args, session._timeout_option(options), future))
+        return future
+
+    def notify(self, method, *args):
+        self._submit((method, args, None, None))
+
+    def close(self):
+        """\
+        Closes the connection and stops the loop thread.  Calls which are not
+        answered yet fail with TransportError.
+        """
+
+        if self._closed:
+            return
+        self._closed = True
+        self._loop.add_callback(self._shutdown)
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+        return False
+
+    def _submit(self, call):
+        if self._closed:
+            raise TransportError("Client closed")
+
+        self._queue.append(call)
+        # The loop thread clears the flag before it empties the queue, so at
+        # worst one more callback is scheduled than needed
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.add_callback(self._drain)
+
+    def _run(self):
+        while not self._closed or self._client._transport is not None:
+            self._loop.start()
+
+    def _drain(self):
+        self._scheduled = False
+        queue = self._queue
+        while queue:
+            method, args, timeout, future = queue.popleft()
+            if future is None:
+                self._client._send_notify(method, args)
+            elif future.set_running_or_notify_cancel():
+                self._client.send_request(method, args, timeout).add_done_callback(
+                    lambda f, future=future: _resolve(future, f))
+
+    def _shutdown(self):
+        self._drain()
+        pending = list(self._client._request_table.values())
+        self._client.close()
+        for future in pending:
+            future.set_error(TransportError("Client closed"))
+        self._loop.dettach_periodic_callback()
+        self._loop.stop()
+
+
+def _resolve(future, result):
+    # result is done, so get() does not run the loop
+    try:
+        future.set_result(result.get())
+    except Exception as e:
+        future.set_exception(e)
@@ -0,0 +1,102 @@
+"""\
+Codecs for the compression of the frames sent over a connection.
+
+Pass compression= to Client and Server: a codec name, a list of names in the
+order of preference, or True for every available codec.  When it connects,
+the client offers its codecs in a handshake and the server answers with the
+first one it accepts too; peers without compression never answer, so the
+connection stays uncompressed.  Only the write batches of compress_threshold
+bytes or more are compressed, and only when that makes them smaller.
+
+zlib is always available; lz4 and zstd when the lz4 and zstandard packages
+are installed.  More codecs can be added by register().
+"""
+
+import zlib
+
+
+class Codec(object):
+    """\
+    A named pair of functions which compress and decompress bytes.
+    """
+
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+_codecs = {}
+
+# Preferred first, when a side accepts every available codec
+_preference = []
+
+
+def register(codec, preferred=False):
+    """\
+    Makes the codec available under its name.
+    """
+
+    if codec.name in _codecs:
+        _preference.remove(codec.name)
+    _codecs[codec.name] = codec
+    if preferred:
+        _preference.insert(0, codec.name)
+    else:
+        _preference.append(codec.name)
+
+
+def get(name):
+    return _codecs.get(name)
+
+
+def available():
+    return list(_preference)
+
+
+def resolve(compression):
+    """\
+    Returns the list of codec names for the compression= option.
+    """
+
+    if not compression:
+        return []
+    if compression is True:
+        return available()
+
+    names = [compression] if isinstance(compression, str) else list(compression)
+    for name in names:
+        if name not in _codecs:
+            raise ValueError("Unknown compression: {0}".format(name))
+    return names
+
+
+def negotiate(offered, accepted):
+    """\
+    Returns the first of the offered codec names which is accepted, or None.
+    """
+
+    for name in offered:
+        if name in accepted:
+            return name
+    return None
+
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    # The (de)compressor objects are not thread-safe
+    register(Codec('zstd',
+                   lambda data: zstandard.ZstdCompressor().compress(data),
+                   lambda data: zstandard.ZstdDecompressor().decompress(data)))
+
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register(Codec('lz4', lz4.frame.compress, lz4.frame.decompress))
+
+register(Codec('zlib', zlib.compress, zlib.decompress))
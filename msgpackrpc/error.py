@@ -1,3 +1,6 @@
+from msgpackrpc.compat import force_str
+
+
 class RPCError(Exception):
     CODE = ".RPCError"
 
@@ -9,10 +12,18 @@ class RPCError(Exception):
         return self.__class__.CODE
 
     def to_msgpack(self):
-        return [self.message]
+        return [self.code, str(self)]
 
     @staticmethod
     def from_msgpack(message):
+        """\
+        Rebuilds the error sent by to_msgpack(), or wraps any other error object.
+        """
+
+        if isinstance(message, (list, tuple)) and len(message) == 2:
+            cls = _CODES.get(force_str(message[0]))
+            if cls is not None:
+                return cls(force_str(message[1]))
         return RPCError(message)
 
 class TimeoutError(RPCError):
@@ -34,3 +45,16 @@ class NoMethodError(CallError):
 class ArgumentError(CallError):
     CODE = ".CallError.ArgumentError"
     pass
+
+class OverloadError(RPCError):
+    CODE = ".OverloadError"
+    pass
+
+
+def _error_classes(cls):
+    yield cls
+    for subclass in cls.__subclasses__():
+        for c in _error_classes(subclass):
+            yield c
+
+_CODES = dict((cls.CODE, cls) for cls in _error_classes(RPCError))
@@ -0,0 +1,265 @@
+"""\
+Receive buffer which frames MessagePack objects without copying them.
+
+Data is read straight into a growable bytearray.  Complete objects are found
+by walking their headers only (payloads are skipped), then decoded from a
+memoryview of the buffer.  Optionally, large bin fields are returned as
+memoryviews into the buffer instead of new bytes objects.  Without an unpack
+encoding, raw (str family) fields come back as bytes, so they are treated as
+bin fields too.
+"""
+
+import struct
+
+import msgpack
+
+
+_BIN = 0
+_STR = 1
+_EXT = 2
+
+# first byte -> (kind, size of the length field) for variable-sized types
+_VARIABLE = {
+    0xc4: (_BIN, 1), 0xc5: (_BIN, 2), 0xc6: (_BIN, 4),
+    0xd9: (_STR, 1), 0xda: (_STR, 2), 0xdb: (_STR, 4),
+    0xc7: (_EXT, 1), 0xc8: (_EXT, 2), 0xc9: (_EXT, 4),
+}
+
+# first byte -> total size of fixed-sized types (nil, bool, numbers, fixext)
+_FIXED = {
+    0xc0: 1, 0xc2: 1, 0xc3: 1,
+    0xca: 5, 0xcb: 9,
+    0xcc: 2, 0xcd: 3, 0xce: 5, 0xcf: 9,
+    0xd0: 2, 0xd1: 3, 0xd2: 5, 0xd3: 9,
+    0xd4: 3, 0xd5: 4, 0xd6: 6, 0xd7: 10, 0xd8: 18,
+}
+
+_LENGTH = {1: struct.Struct('>B'), 2: struct.Struct('>H'), 4: struct.Struct('>I')}
+
+
+def frame_size(view, start, end, bin_threshold=None, raw=False):
+    """\
+    Walks the object at view[start:end].
+
+    Returns (size, large) when the object is complete, where large tells
+    whether it has a bin field (or a raw field, if raw) of bin_threshold bytes
+    or more.  Returns (None, needed) otherwise, where needed is a lower bound
+    of its size.
+    """
+
+    pos = start
+    remaining = 1
+    large = False
+    stack = []
+
+    while True:
+        while remaining == 0:
+            if not stack:
+                return pos - start, large
+            remaining = stack.pop()
+
+        if pos >= end:
+            return None, pos - start + 1
+        remaining -= 1
+
+        b = view[pos]
+        if b <= 0x7f or b >= 0xe0:
+            pos += 1
+        elif b <= 0x8f:
+            pos += 1
+            stack.append(remaining)
+            remaining = (b & 0x0f) * 2
+        elif b <= 0x9f:
+            pos += 1
+            stack.append(remaining)
+            remaining = b & 0x0f
+        elif b <= 0xbf:
+            pos += 1 + (b & 0x1f)
+        elif b in _FIXED:
+            pos += _FIXED[b]
+        elif b in _VARIABLE:
+            kind, width = _VARIABLE[b]
+            if pos + 1 + width > end:
+                return None, pos - start + 1 + width
+            length = _LENGTH[width].unpack_from(view, pos + 1)[0]
+            if kind == _EXT:
+                length += 1
+            elif (kind == _BIN or raw) and bin_threshold is not None and length >= bin_threshold:
+                large = True
+            pos += 1 + width + length
+        elif 0xdc <= b <= 0xdf:
+            width = 2 if b in (0xdc, 0xde) else 4
+            if pos + 1 + width > end:
+                return None, pos - start + 1 + width
+            count = _LENGTH[width].unpack_from(view, pos + 1)[0]
+            pos += 1 + width
+            stack.append(remaining)
+            remaining = count if b <= 0xdd else count * 2
+        else:
+            raise ValueError("Invalid MessagePack byte: 0x{0:02x}".format(b))
+
+        if pos > end:
+            return None, pos - start
+
+
+_STRUCTS = {
+    0xca: struct.Struct('>f'), 0xcb: struct.Struct('>d'),
+    0xcc: struct.Struct('>B'), 0xcd: struct.Struct('>H'), 0xce: struct.Struct('>I'), 0xcf: struct.Struct('>Q'),
+    0xd0: struct.Struct('>b'), 0xd1: struct.Struct('>h'), 0xd2: struct.Struct('>i'), 0xd3: struct.Struct('>q'),
+}
+_FIXEXT = {0xd4: 1, 0xd5: 2, 0xd6: 4, 0xd7: 8, 0xd8: 16}
+
+
+def unpack_view(view, encoding=None, bin_threshold=0, ext_hook=msgpack.ExtType):
+    """\
+    Decodes the complete object in view.  bin fields (and raw fields, if
+    encoding is None) of bin_threshold bytes or more are returned as
+    memoryviews of view, the rest as with msgpack.unpackb.
+    """
+
+    obj, pos = _unpack(view, 0, encoding, bin_threshold, ext_hook)
+    return obj
+
+
+def _unpack(view, pos, encoding, bin_threshold, ext_hook):
+    b = view[pos]
+    if b <= 0x7f:
+        return b, pos + 1
+    if b >= 0xe0:
+        return b - 0x100, pos + 1
+    if b <= 0x8f:
+        return _unpack_map(view, pos + 1, b & 0x0f, encoding, bin_threshold, ext_hook)
+    if b <= 0x9f:
+        return _unpack_array(view, pos + 1, b & 0x0f, encoding, bin_threshold, ext_hook)
+    if b <= 0xbf:
+        return _raw(view, pos + 1, b & 0x1f, encoding, bin_threshold)
+    if b == 0xc0:
+        return None, pos + 1
+    if b == 0xc2:
+        return False, pos + 1
+    if b == 0xc3:
+        return True, pos + 1
+    if b in _STRUCTS:
+        s = _STRUCTS[b]
+        return s.unpack_from(view, pos + 1)[0], pos + 1 + s.size
+    if b in _FIXEXT:
+        length = _FIXEXT[b]
+        code = struct.unpack_from('>b', view, pos + 1)[0]
+        start = pos + 2
+        return ext_hook(code, view[start:start + length].tobytes()), start + length
+    if b in _VARIABLE:
+        kind, width = _VARIABLE[b]
+        length = _LENGTH[width].unpack_from(view, pos + 1)[0]
+        start = pos + 1 + width
+        if kind == _STR:
+            return _raw(view, start, length, encoding, bin_threshold)
+        if kind == _BIN:
+            data = view[start:start + length]
+            return (data if length >= bin_threshold else data.tobytes()), start + length
+        code = struct.unpack_from('>b', view, start)[0]
+        start += 1
+        return ext_hook(code, view[start:start + length].tobytes()), start + length
+    if b in (0xdc, 0xdd):
+        width = 2 if b == 0xdc else 4
+        count = _LENGTH[width].unpack_from(view, pos + 1)[0]
+        return _unpack_array(view, pos + 1 + width, count, encoding, bin_threshold, ext_hook)
+    if b in (0xde, 0xdf):
+        width = 2 if b == 0xde else 4
+        count = _LENGTH[width].unpack_from(view, pos + 1)[0]
+        return _unpack_map(view, pos + 1 + width, count, encoding, bin_threshold, ext_hook)
+    raise ValueError("Invalid MessagePack byte: 0x{0:02x}".format(b))
+
+
+def _raw(view, start, length, encoding, bin_threshold):
+    data = view[start:start + length]
+    if encoding is not None:
+        return data.tobytes().decode(encoding), start + length
+    return (data if length >= bin_threshold else data.tobytes()), start + length
+
+
+def _unpack_array(view, pos, count, encoding, bin_threshold, ext_hook):
+    result = []
+    for _ in range(count):
+        obj, pos = _unpack(view, pos, encoding, bin_threshold, ext_hook)
+        result.append(obj)
+    return result, pos
+
+
+def _unpack_map(view, pos, count, encoding, bin_threshold, ext_hook):
+    result = {}
+    for _ in range(count):
+        key, pos = _unpack(view, pos, encoding, bin_threshold, ext_hook)
+        value, pos = _unpack(view, pos, encoding, bin_threshold, ext_hook)
+        result[key] = value
+    return result, pos
+
+
+class ReceiveBuffer(object):
+    """\
+    Growable buffer for BufferedProtocol.get_buffer()/buffer_updated().
+
+    Once memoryviews of large bin fields were handed out, the bytearray is
+    never compacted in place; the unread tail is moved to a new bytearray.
+    """
+
+    MIN_READ = 64 * 1024
+
+    def __init__(self, encoding=None, bin_view_threshold=None, ext_hook=msgpack.ExtType):
+        self._encoding = encoding
+        self._bin_view_threshold = bin_view_threshold
+        self._ext_hook = ext_hook
+        self._data = bytearray(self.MIN_READ)
+        self._start = 0
+        self._end = 0
+        self._needed = 0
+        self._exported = False
+
+    def get_buffer(self, sizehint=-1):
+        want = max(sizehint, self.MIN_READ, self._needed - (self._end - self._start))
+        if len(self._data) - self._end < want:
+            self._reserve(want)
+        return memoryview(self._data)[self._end:]
+
+    def _reserve(self, want):
+        pending = self._end - self._start
+        if not self._exported and len(self._data) >= pending + want:
+            # Compact in place
+            self._data[:pending] = self._data[self._start:self._end]
+        else:
+            size = max(len(self._data), self.MIN_READ)
+            while size < pending + want:
+                size *= 2
+            data = bytearray(size)
+            data[:pending] = self._data[self._start:self._end]
+            self._data = data
+            self._exported = False
+        self._start = 0
+        self._end = pending
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    def messages(self):
+        """\
+        Yields the complete objects in the buffer.
+        """
+
+        view = memoryview(self._data)
+        threshold = self._bin_view_threshold
+        while self._start < self._end:
+            size, large = frame_size(view, self._start, self._end, threshold, self._encoding is None)
+            if size is None:
+                self._needed = large
+                break
+
+            frame = view[self._start:self._start + size]
+            self._start += size
+            self._needed = 0
+            if large:
+                self._exported = True
+                yield unpack_view(frame, self._encoding, threshold, self._ext_hook)
+            else:
+                yield msgpack.unpackb(frame, encoding=self._encoding, ext_hook=self._ext_hook)
+
+        if self._start == self._end and not self._exported:
+            self._start = self._end = 0
@@ -1,3 +1,5 @@
+from collections import deque
+
 from msgpackrpc import error
 
 
@@ -5,6 +7,10 @@ class Future(object):
     """
     This class is used as the result of asynchronous call.
     By using join(), the caller is able to wait for the completion.
+
+    The future is resolved by the transport callbacks and never stops the
+    loop by itself: join() runs the loop only until this future is set, and
+    add_done_callback() / await let many futures complete in one loop run.
     """
 
     def __init__(self, loop, timeout, callback=None):
@@ -16,11 +22,22 @@ class Future(object):
         self._callback = callback
         self._error_handler = None
         self._result_handler = None
+        self._done_callbacks = []
 
     def join(self):
+        if self._set_flag:
+            return
+
+        self.add_done_callback(self._stop_loop)
         while (not self._set_flag):
             self._loop.start()
 
+    def _stop_loop(self, future):
+        self._loop.stop()
+
+    def done(self):
+        return self._set_flag
+
     def get(self):
         self.join()
 
@@ -42,24 +59,28 @@ class Future(object):
                     if isinstance(self._error, error.RPCError):
                         raise self._error
                     else:
-                        raise error.RPCError(self._error)
+                        raise error.RPCError.from_msgpack(self._error)
             else:
                 return self._result
 
     def set(self, error=None, result=None):
         self._error = error
         self._result = result
+        self._set_flag = True
 
         if self._callback is not None:
             self._callback(self)
 
+        callbacks, self._done_callbacks = self._done_callbacks, []
+        for callback in callbacks:
+            callback(self)
+
     @property
     def result(self):
         return self._result
 
     def set_result(self, result):
         self.set(result=result)
-        self._set_flag = True
 
     @property
     def error(self):
@@ -67,7 +88,6 @@ class Future(object):
 
     def set_error(self, error):
         self.set(error=error)
-        self._set_flag = True
 
     def attach_callback(self, callback):
         self._callback = callback
@@ -78,11 +98,224 @@ class Future(object):
     def attach_result_handler(self, handler):
         self._result_handler = handler
 
-    # better name?
-    def step_timeout(self):
-        if self._timeout < 1:
-            return True
+    def add_done_callback(self, callback):
+        """\
+        Calls callback(future) when the future is set, or immediately if it is
+        already set. Unlike attach_callback, any number of callbacks may be added.
+        """
+
+        if self._set_flag:
+            callback(self)
+        else:
+            self._done_callbacks.append(callback)
+
+    def __await__(self):
+        """\
+        Waits for the result in a coroutine running on the loop, which must
+        support create_future().
+        """
+
+        waiter = self._loop.create_future()
+        self.add_done_callback(lambda future: future._resolve(waiter))
+        return waiter.__await__()
+
+    def _resolve(self, waiter):
+        if waiter.done():
+            return
+        try:
+            waiter.set_result(self.get())
+        except Exception as e:
+            waiter.set_exception(e)
+
+
+class MultiFuture(object):
+    """
+    This class groups the futures of a batch call.
+    By using get(), the caller gets the results in order; as_completed()
+    yields them in the order they arrive.
+    """
+
+    def __init__(self, loop, futures):
+        self._loop = loop
+        self._futures = futures
+        self._completed = deque()
+        self._waiting = False
+        self._done_callbacks = []
+        for index, future in enumerate(futures):
+            future.add_done_callback(lambda f, index=index: self._on_done(index))
+
+    @property
+    def futures(self):
+        return self._futures
+
+    def __len__(self):
+        return len(self._futures)
+
+    def done(self):
+        return all(future.done() for future in self._futures)
+
+    def _on_done(self, index):
+        self._completed.append(index)
+        if self._waiting:
+            self._waiting = False
+            self._loop.stop()
+
+        if len(self._completed) == len(self._futures):
+            callbacks, self._done_callbacks = self._done_callbacks, []
+            for callback in callbacks:
+                callback(self)
+
+    def add_done_callback(self, callback):
+        if self.done():
+            callback(self)
+        else:
+            self._done_callbacks.append(callback)
+
+    def join(self):
+        for future in self._futures:
+            future.join()
+
+    def get(self, return_exceptions=False):
+        """\
+        Returns the list of results in the order of the calls.  Raises the first
+        error, or puts the RPCError in place of the result if return_exceptions.
+        """
+
+        self.join()
+        results = []
+        for future in self._futures:
+            try:
+                results.append(future.get())
+            except error.RPCError as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+    def as_completed(self):
+        """\
+        Yields (index, future) as each call completes, running the loop as needed.
+        """
+
+        seen = 0
+        while seen < len(self._futures):
+            while seen >= len(self._completed):
+                self._waiting = True
+                self._loop.start()
+            index = self._completed[seen]
+            seen += 1
+            yield index, self._futures[index]
+
+    def __await__(self):
+        waiter = self._loop.create_future()
+        def resolve(multi):
+            if waiter.done():
+                return
+            try:
+                waiter.set_result(multi.get())
+            except Exception as e:
+                waiter.set_exception(e)
+        self.add_done_callback(resolve)
+        return waiter.__await__()
+
+
+try:
+    _StopAsyncIteration = StopAsyncIteration
+except NameError:
+    # Python < 3.5
+    _StopAsyncIteration = StopIteration
+
+
+class Stream(object):
+    """
+    This class is used as the result of streaming call.
+    Iterating over it (with for, or async for in a coroutine) yields the chunks
+    as they arrive.  Each chunk taken grants the server credit to send another,
+    so at most `window` chunks are buffered.
+    """
+
+    def __init__(self, session, msgid, window):
+        self._session = session
+        self._loop = session._loop
+        self._msgid = msgid
+        self._window = window
+        self._chunks = deque()
+        self._taken = 0
+        self._done = False
+        self._error = None
+        self._waiting = False
+        self._waiter = None
+
+    def on_chunk(self, chunk):
+        self._chunks.append(chunk)
+        self._wake()
+
+    def on_end(self, error):
+        self._done = True
+        self._error = error
+        self._wake()
+
+    def _wake(self):
+        if self._waiting:
+            self._waiting = False
+            self._loop.stop()
+        if self._waiter is not None:
+            waiter, self._waiter = self._waiter, None
+            self._settle(waiter)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._chunks and not self._done:
+            if self._loop.running():
+                raise RuntimeError("use async for to iterate a stream from the running loop")
+            self._waiting = True
+            self._loop.start()
+        return self._take()
+
+    next = __next__
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        waiter = self._loop.create_future()
+        if self._chunks or self._done:
+            self._settle(waiter)
         else:
-            self._timeout -= 1
-            return False
+            self._waiter = waiter
+        return waiter
+
+    def _settle(self, waiter):
+        try:
+            waiter.set_result(self._take())
+        except StopIteration:
+            waiter.set_exception(_StopAsyncIteration())
+        except Exception as e:
+            waiter.set_exception(e)
+
+    def _take(self):
+        if self._chunks:
+            chunk = self._chunks.popleft()
+            self._taken += 1
+            if not self._done and self._taken >= max(1, self._window // 2):
+                self._session._send_credit(self._msgid, self._taken)
+                self._taken = 0
+            return chunk
+
+        if self._error is not None:
+            if isinstance(self._error, error.RPCError):
+                raise self._error
+            raise error.RPCError.from_msgpack(self._error)
+        raise StopIteration
+
+    def close(self):
+        """\
+        Stops the stream; the server stops the generator.
+        """
 
+        if not self._done:
+            self._done = True
+            self._chunks.clear()
+            self._session._cancel_stream(self._msgid)
@@ -1,5 +1,20 @@
+import time
+
 from tornado import ioloop
 
+try:
+    from tornado.concurrent import Future as _TornadoFuture
+except ImportError:
+    # Tornado < 3 has no Future to await on
+    _TornadoFuture = None
+
+try:
+    from concurrent.futures import CancelledError
+except ImportError:
+    # Python 2 without the futures backport
+    class CancelledError(Exception):
+        pass
+
 class Loop(object):
     """\
     An I/O loop class which wraps the Tornado's ioloop.
@@ -21,6 +36,9 @@ class Loop(object):
         if not self._ioloop.running():
             self._ioloop.start()
 
+    def running(self):
+        return self._ioloop.running()
+
     def stop(self):
         """\
         Stops the Tornado's ioloop if it's running.
@@ -32,6 +50,54 @@ class Loop(object):
             except:
                 return
 
+    def add_callback(self, callback):
+        """\
+        Calls callback on the next iteration. Safe to call from other threads.
+        """
+
+        self._ioloop.add_callback(callback)
+
+    def add_callback_from_signal(self, callback):
+        """\
+        Calls callback on the next iteration. Safe to call from signal handlers.
+        """
+
+        # Tornado < 3 has no add_callback_from_signal
+        add = getattr(self._ioloop, 'add_callback_from_signal', self._ioloop.add_callback)
+        add(callback)
+
+    def add_timeout(self, delay, callback):
+        """\
+        Calls callback after delay seconds. Returns the handle for remove_timeout().
+        """
+
+        return self._ioloop.add_timeout(time.time() + delay, callback)
+
+    def remove_timeout(self, handle):
+        self._ioloop.remove_timeout(handle)
+
+    def create_future(self):
+        """\
+        Creates the Tornado's Future, which native coroutines can await.
+        """
+
+        if _TornadoFuture is None:
+            raise NotImplementedError("await requires Tornado >= 3")
+        return _TornadoFuture()
+
+    def spawn(self, awaitable):
+        """\
+        Runs the coroutine (or other awaitable) on the loop. Returns the Future
+        of its result; its cancel() throws CancelledError into the coroutine.
+        """
+
+        future = self.create_future()
+        task = _Task(self, awaitable, future)
+        # The Tornado's Future cannot be cancelled by itself
+        future.cancel = task.cancel
+        task.step()
+        return future
+
     def attach_periodic_callback(self, callback, callback_time):
         if self._periodic_callback is not None:
             self.dettach_periodic_callback()
@@ -43,3 +109,57 @@ class Loop(object):
         if self._periodic_callback is not None:
             self._periodic_callback.stop()
         self._periodic_callback = None
+
+
+class _Task(object):
+    """\
+    Drives a coroutine which awaits futures, resuming it on the loop.
+    """
+
+    def __init__(self, loop, coroutine, future):
+        self._loop = loop
+        self._coroutine = coroutine
+        self._future = future
+        # Identifies the current wait, so that a cancelled one does not resume
+        self._token = None
+
+    def step(self):
+        self._advance(self._coroutine.send, None)
+
+    def cancel(self):
+        if self._future.done():
+            return False
+        self._advance(self._coroutine.throw, CancelledError())
+        return True
+
+    def _wake(self, token, awaited):
+        if token is not self._token:
+            return
+        if awaited is None:
+            self._advance(self._coroutine.send, None)
+            return
+
+        try:
+            value = awaited.result()
+        except Exception as e:
+            self._advance(self._coroutine.throw, e)
+            return
+        self._advance(self._coroutine.send, value)
+
+    def _advance(self, resume, value):
+        self._token = None
+        try:
+            yielded = resume(value)
+        except StopIteration as e:
+            self._future.set_result(getattr(e, 'value', None))
+            return
+        except Exception as e:
+            self._future.set_exception(e)
+            return
+
+        token = self._token = object()
+        if yielded is None:
+            # A bare yield, e.g. asyncio.sleep(0)
+            self._loop.add_callback(lambda: self._wake(token, None))
+        else:
+            yielded.add_done_callback(lambda f: self._loop.add_callback(lambda: self._wake(token, f)))
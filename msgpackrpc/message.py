@@ -1,3 +1,16 @@
 REQUEST = 0
 RESPONSE = 1
 NOTIFY = 2
+STREAM = 3
+CREDIT = 4
+
+# MessagePack extension types used by the transports
+EXT_SHM = 1
+EXT_COMPRESSED = 2
+EXT_DATETIME = 3
+EXT_NAIVE_DATETIME = 4
+EXT_DECIMAL = 5
+EXT_NDARRAY = 6
+
+# Method of the NOTIFY which exchanges the options of a connection
+HANDSHAKE = 'msgpackrpc.handshake'
@@ -0,0 +1,213 @@
+"""\
+Instrumentation of Client/Session and Server.
+
+Pass a Metrics object as metrics= to Client or Server.  Every sample carries
+a side label ('client' or 'server'), so a Client and a Server running on the
+same loop may share one; calls also carry the method.  Without metrics (the
+default) nothing is recorded.
+
+Counters:   requests, notifies, errors, timeouts, overloads, bytes_in, bytes_out,
+            compress_bytes_in, compress_bytes_out,
+            cache_hits, cache_misses, cache_coalesced, cancels
+Gauges:     in_flight, pending_write_bytes, cache_bytes
+Histograms: request_seconds (latency per method), compress_seconds, decompress_seconds
+
+in_flight counts the requests waiting for their response, and
+pending_write_bytes the bytes packed into write batches but not yet handed
+to the stream.  cancels counts the requests the server dropped unanswered.  The compression samples carry the codec; the ratio is
+compress_bytes_out / compress_bytes_in, counted over the compressed batches.
+"""
+
+import threading
+
+from msgpackrpc.compat import iteritems
+
+
+class Histogram(object):
+    """\
+    Log-linear histogram in the style of HdrHistogram.
+
+    Values are recorded in microseconds.  Each power of two is split into
+    2 ** SUB_BITS linear buckets, so a percentile is within 1 / 2 ** SUB_BITS
+    (about 6%) of the recorded value while recording is a few integer
+    operations.
+    """
+
+    SUB_BITS = 4
+    UNIT = 1e-6
+
+    def __init__(self):
+        self._counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        value = int(seconds / self.UNIT)
+        if value < 0:
+            value = 0
+        index = _bucket(value, self.SUB_BITS)
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """\
+        Returns the upper bound of the bucket holding the percentile p (0-100),
+        in seconds, or None if nothing was recorded.
+        """
+
+        if self.count == 0:
+            return None
+
+        rank = max(1, int(self.count * p / 100.0 + 0.5))
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= rank:
+                return min(_upper(index, self.SUB_BITS) * self.UNIT, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9),
+        }
+
+
+def _bucket(value, sub_bits):
+    if value < 2 << sub_bits:
+        return value
+    shift = value.bit_length() - sub_bits - 1
+    return (shift << sub_bits) + (value >> shift)
+
+
+def _upper(index, sub_bits):
+    if index < 2 << sub_bits:
+        return index
+    shift = (index >> sub_bits) - 1
+    top = index - (shift << sub_bits)
+    return ((top + 1) << shift) - 1
+
+
+class Metrics(object):
+    """\
+    Registry of counters, gauges and latency histograms.
+
+    Samples are keyed by name and labels.  Recording is not locked; it happens
+    on the loop thread of the Client or Server.  snapshot() and prometheus()
+    may be called from any thread.
+    """
+
+    QUANTILES = (50, 90, 99, 99.9)
+
+    def __init__(self, namespace='msgpackrpc'):
+        self._namespace = namespace
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauge(self, name, delta, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._gauges[key] = self._gauges.get(key, 0) + delta
+
+    def set_gauge(self, name, value, **labels):
+        self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.record(seconds)
+
+    def counter(self, name, **labels):
+        return self._counters.get((name, tuple(sorted(labels.items()))), 0)
+
+    def gauge(self, name, **labels):
+        return self._gauges.get((name, tuple(sorted(labels.items()))), 0)
+
+    def histogram(self, name, **labels):
+        return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    def snapshot(self):
+        """\
+        Returns {'counters': ..., 'gauges': ..., 'histograms': ...}, each mapping
+        a name to a list of {'labels': {...}, 'value': ...}.  The value of a
+        histogram is the dict of Histogram.snapshot().
+        """
+
+        def group(samples, value):
+            grouped = {}
+            for (name, labels), sample in samples:
+                grouped.setdefault(name, []).append({'labels': dict(labels), 'value': value(sample)})
+            return grouped
+
+        return {
+            'counters': group(list(iteritems(self._counters)), lambda v: v),
+            'gauges': group(list(iteritems(self._gauges)), lambda v: v),
+            'histograms': group(list(iteritems(self._histograms)), lambda h: h.snapshot()),
+        }
+
+    def prometheus(self):
+        """\
+        Returns the samples in the Prometheus text exposition format.
+        Histograms are exposed as summaries.
+        """
+
+        lines = []
+        for name, samples in sorted(self._by_name(self._counters).items()):
+            full = '{0}_{1}_total'.format(self._namespace, name)
+            lines.append('# TYPE {0} counter'.format(full))
+            for labels, value in samples:
+                lines.append('{0}{1} {2}'.format(full, _format_labels(labels), value))
+
+        for name, samples in sorted(self._by_name(self._gauges).items()):
+            full = '{0}_{1}'.format(self._namespace, name)
+            lines.append('# TYPE {0} gauge'.format(full))
+            for labels, value in samples:
+                lines.append('{0}{1} {2}'.format(full, _format_labels(labels), value))
+
+        for name, samples in sorted(self._by_name(self._histograms).items()):
+            full = '{0}_{1}'.format(self._namespace, name)
+            lines.append('# TYPE {0} summary'.format(full))
+            for labels, histogram in samples:
+                for q in self.QUANTILES:
+                    quantile = labels + (('quantile', repr(q / 100.0)),)
+                    lines.append('{0}{1} {2!r}'.format(full, _format_labels(quantile), histogram.percentile(q) or 0.0))
+                lines.append('{0}_sum{1} {2!r}'.format(full, _format_labels(labels), histogram.sum))
+                lines.append('{0}_count{1} {2}'.format(full, _format_labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _by_name(samples):
+        grouped = {}
+        for (name, labels), value in list(iteritems(samples)):
+            grouped.setdefault(name, []).append((labels, value))
+        for values in grouped.values():
+            values.sort(key=lambda sample: sample[0])
+        return grouped
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, _escape(value)) for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,136 @@
+import errno
+import os
+import signal
+import time
+
+
+class Supervisor(object):
+    """\
+    Forks worker processes which serve the listening sockets of a Server, and
+    keeps them running.
+
+    The sockets are bound once by Server.listen() in this process, so every
+    worker accepts on the same sockets and the kernel spreads the connections.
+    Crashed workers are respawned.  SIGHUP replaces all workers gracefully:
+    new workers are forked first, then the old ones stop accepting and exit
+    after grace_period seconds.  SIGTERM/SIGINT stop all workers the same way.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self, server, workers, grace_period=10):
+        self._server = server
+        self._num_workers = workers
+        self._grace_period = grace_period
+        self._workers = {}   # pid -> spawn time
+        self._retired = set()
+        self._stopping = False
+        self._reloading = False
+
+    def run(self):
+        """\
+        Runs until the supervisor is asked to stop and every worker exited.
+        """
+
+        handlers = {}
+        for signum, handler in ((signal.SIGTERM, self._on_stop),
+                                (signal.SIGINT, self._on_stop),
+                                (signal.SIGHUP, self._on_reload)):
+            handlers[signum] = signal.signal(signum, handler)
+
+        try:
+            for _ in range(self._num_workers):
+                self._spawn()
+
+            while self._workers:
+                if self._reloading:
+                    self._reloading = False
+                    self._reload()
+                self._reap()
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def _on_stop(self, signum, frame):
+        if not self._stopping:
+            self._stopping = True
+            self._retire(list(self._workers))
+
+    def _on_reload(self, signum, frame):
+        self._reloading = True
+
+    def _reload(self):
+        if self._stopping:
+            return
+
+        old = list(self._workers)
+        for _ in range(self._num_workers):
+            self._spawn()
+        self._retire(old)
+
+    def _retire(self, pids):
+        for pid in pids:
+            self._retired.add(pid)
+            _kill(pid, signal.SIGTERM)
+
+    def _reap(self):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    self._workers.clear()
+                return
+            if pid == 0:
+                return
+
+            started = self._workers.pop(pid, None)
+            if started is None:
+                continue
+            if pid in self._retired:
+                self._retired.discard(pid)
+            elif not self._stopping:
+                # Crashed; avoid a fork loop when the worker dies on startup
+                if time.time() - started < 1:
+                    time.sleep(1)
+                self._spawn()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self._run_worker()
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                status = 1
+            os._exit(status)
+
+        self._workers[pid] = time.time()
+        return pid
+
+    def _run_worker(self):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        server = self._server
+        server._after_fork()
+
+        def _stop():
+            server.close()
+            server._loop.add_timeout(self._grace_period, server._loop.stop)
+        signal.signal(signal.SIGTERM, lambda signum, frame: server._loop.add_callback_from_signal(_stop))
+
+        server._loop.start()
+
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
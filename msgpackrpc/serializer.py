@@ -0,0 +1,209 @@
+"""\
+Registry of the Python types sent as MessagePack extension types.
+
+Client and Server pack the objects which MessagePack cannot represent with
+the serializer registered for their type, and unpack the extension types by
+their code.  Both use REGISTRY unless serializers= is given, so a type
+registered once by register() works on either side.  Objects of other types
+fall back to their to_msgpack() method.
+
+Built in:
+
+datetime  as the 32, 64 or 96 bit layout of the MessagePack timestamp type;
+          aware datetimes come back in UTC, naive ones stay naive.
+Decimal   as its string.
+ndarray   (when numpy is installed) as a dtype/shape header and the raw
+          buffer, decoded without copying it again.
+
+Codes 0-15 are reserved for the library; use 16-127 for your own types.
+"""
+
+import datetime
+import decimal
+import struct
+
+import msgpack
+
+from msgpackrpc import message
+
+
+class Serializer(object):
+    """\
+    encode(obj) returns the bytes of the extension type code (or a
+    msgpack.ExtType of another code), and decode(data) the object from them.
+    """
+
+    def __init__(self, type, code, encode, decode):
+        self.type = type
+        self.code = code
+        self.encode = encode
+        self.decode = decode
+
+
+class Registry(object):
+    def __init__(self):
+        self._by_type = {}
+        self._by_code = {}
+        # type -> Serializer (or None) found for the subclasses of registered types
+        self._resolved = {}
+
+    def register(self, type, code, encode, decode):
+        """\
+        Sends the objects of type (and of its subclasses) as the extension type code.
+        """
+
+        if not 0 <= code <= 127:
+            raise ValueError("Extension type code must be 0-127: {0}".format(code))
+        serializer = Serializer(type, code, encode, decode)
+        self._by_type[type] = serializer
+        self._by_code[code] = serializer
+        self._resolved = {}
+
+    def register_decoder(self, code, decode):
+        """\
+        Decodes the extension type code, which is sent by another serializer of
+        the same code (e.g. for another type which decodes the same).
+        """
+
+        self._by_code[code] = Serializer(None, code, None, decode)
+
+    def default(self, obj):
+        """\
+        The default function of msgpack.Packer.
+        """
+
+        serializer = self._by_type.get(type(obj))
+        if serializer is None:
+            serializer = self._resolve(type(obj))
+            if serializer is None:
+                return obj.to_msgpack()
+        data = serializer.encode(obj)
+        if isinstance(data, msgpack.ExtType):
+            return data
+        return msgpack.ExtType(serializer.code, data)
+
+    def _resolve(self, cls):
+        try:
+            return self._resolved[cls]
+        except KeyError:
+            pass
+
+        found = None
+        for base in cls.__mro__[1:]:
+            found = self._by_type.get(base)
+            if found is not None:
+                break
+        self._resolved[cls] = found
+        return found
+
+    def ext_hook(self, code, data):
+        """\
+        The ext_hook function of msgpack.Unpacker.  Unknown codes are returned
+        as msgpack.ExtType.
+        """
+
+        serializer = self._by_code.get(code)
+        if serializer is None:
+            return msgpack.ExtType(code, data)
+        return serializer.decode(data)
+
+
+try:
+    _UTC = datetime.timezone.utc
+except AttributeError:
+    # Python 2
+    class _UTCType(datetime.tzinfo):
+        def utcoffset(self, dt):
+            return datetime.timedelta(0)
+
+        def tzname(self, dt):
+            return 'UTC'
+
+        def dst(self, dt):
+            return datetime.timedelta(0)
+
+    _UTC = _UTCType()
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_TIMESTAMP32 = struct.Struct('>I')
+_TIMESTAMP64 = struct.Struct('>Q')
+_TIMESTAMP96 = struct.Struct('>Iq')
+
+
+def _encode_datetime(dt):
+    if dt.tzinfo is None:
+        return msgpack.ExtType(message.EXT_NAIVE_DATETIME, _timestamp(dt))
+    return _timestamp(dt.replace(tzinfo=None) - dt.utcoffset())
+
+
+def _timestamp(dt):
+    delta = dt - _EPOCH
+    seconds = delta.days * 86400 + delta.seconds
+    nanoseconds = delta.microseconds * 1000
+    if seconds >> 34 == 0:
+        data64 = nanoseconds << 34 | seconds
+        if data64 >> 32 == 0:
+            return _TIMESTAMP32.pack(data64)
+        return _TIMESTAMP64.pack(data64)
+    return _TIMESTAMP96.pack(nanoseconds, seconds)
+
+
+def _decode_timestamp(data):
+    if len(data) == 4:
+        seconds, nanoseconds = _TIMESTAMP32.unpack(data)[0], 0
+    elif len(data) == 8:
+        data64 = _TIMESTAMP64.unpack(data)[0]
+        seconds, nanoseconds = data64 & 0x3ffffffff, data64 >> 34
+    else:
+        nanoseconds, seconds = _TIMESTAMP96.unpack(data)
+    return _EPOCH + datetime.timedelta(seconds=seconds, microseconds=nanoseconds // 1000)
+
+
+def _encode_decimal(value):
+    return str(value).encode('ascii')
+
+
+def _decode_decimal(data):
+    return decimal.Decimal(bytes(data).decode('ascii'))
+
+
+_NDARRAY_HEADER = struct.Struct('>I')
+
+
+def _encode_ndarray(array):
+    if array.dtype.hasobject:
+        raise TypeError("Arrays of objects cannot be serialized")
+    header = msgpack.packb([array.dtype.str, list(array.shape)])
+    return _NDARRAY_HEADER.pack(len(header)) + header + numpy.ascontiguousarray(array).tobytes()
+
+
+def _decode_ndarray(data):
+    view = memoryview(data)
+    size = _NDARRAY_HEADER.unpack_from(view)[0]
+    start = _NDARRAY_HEADER.size
+    dtype, shape = msgpack.unpackb(view[start:start + size].tobytes())
+    if isinstance(dtype, bytes):
+        dtype = dtype.decode('ascii')
+    return numpy.frombuffer(view[start + size:], dtype=dtype).reshape(shape)
+
+
+def register(type, code, encode, decode):
+    """\
+    Registers the type to REGISTRY.
+    """
+
+    REGISTRY.register(type, code, encode, decode)
+
+
+REGISTRY = Registry()
+REGISTRY.register(datetime.datetime, message.EXT_DATETIME, _encode_datetime,
+                  lambda data: _decode_timestamp(data).replace(tzinfo=_UTC))
+REGISTRY.register_decoder(message.EXT_NAIVE_DATETIME, _decode_timestamp)
+REGISTRY.register(decimal.Decimal, message.EXT_DECIMAL, _encode_decimal, _decode_decimal)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+else:
+    REGISTRY.register(numpy.ndarray, message.EXT_NDARRAY, _encode_ndarray, _decode_ndarray)
@@ -1,31 +1,165 @@
+from collections import deque
+import inspect
+import time
+
 import msgpack
 
 from msgpackrpc.compat import force_str
+from msgpackrpc import cache as _cache
+from msgpackrpc import compression as _compression
 from msgpackrpc import error
 from msgpackrpc import Loop
 from msgpackrpc import message
+from msgpackrpc import prefork
+from msgpackrpc import serializer
 from msgpackrpc import session
 from msgpackrpc.transport import tcp
 
 class Server(session.Session):
     """\
     Server is usaful for MessagePack RPC Server.
+
+    Only registered methods can be called.  The public methods of dispatcher
+    are registered, and register() adds more.  The methods are compiled into
+    an immutable table keyed by the method name as it comes off the wire, so
+    a request costs one dict lookup.
+
+    A method which returns a generator (or async generator) streams its
+    chunks to Session.call_stream as they are produced, while the client
+    grants credit.  A plain call receives the list of all chunks.
+
+    A coroutine method (async def) runs on the loop, so many of them may wait
+    at once and complete in any order.  It is cancelled when its connection
+    closes, or when it runs over the timeout the client sent with the request
+    or handler_timeout.  A closed connection also drops the requests waiting
+    for an AsyncResult.
     """
 
-    def __init__(self, dispatcher, loop=None, builder=tcp, pack_encoding='utf-8', unpack_encoding=None):
-        self._loop = loop or Loop()
+    def __init__(self, dispatcher=None, loop=None, builder=tcp, pack_encoding='utf-8', unpack_encoding=None,
+                 thread_pool=None, process_pool=None, metrics=None,
+                 max_in_flight=None, max_total_in_flight=None, max_write_buffer=None, reject_overload=False,
+                 compression=None, compress_threshold=1024, serializers=None, cache=None,
+                 max_async_handlers=None, handler_timeout=None):
+        """\
+        :param dispatcher:   object whose public methods are registered, or None.
+        :param thread_pool:  executor for methods marked by run_in_thread_pool.
+                             A ThreadPoolExecutor is created on demand if omitted.
+        :param process_pool: executor for methods marked by run_in_process_pool.
+                             A ProcessPoolExecutor is created on demand if omitted.
+        :param metrics:      msgpackrpc.metrics.Metrics which records the requests, or None.
+        :param max_in_flight:       requests of one connection being processed at once.
+        :param max_total_in_flight: requests of all connections being processed at once.
+        :param max_write_buffer:    bytes of responses one connection may buffer unsent.
+        :param reject_overload:     reject requests over the in-flight limits with
+                                    OverloadError instead of waiting for them.
+        :param compression:        codecs accepted from clients; see msgpackrpc.compression.
+        :param compress_threshold: batches of this many bytes or more are compressed.
+        :param serializers:  msgpackrpc.serializer.Registry of the extension types;
+                             serializer.REGISTRY by default.
+        :param cache:        msgpackrpc.cache.ResultCache of the methods, or None.
+        :param max_async_handlers: coroutine methods running at once; the others wait
+                                   for their turn, or fail with OverloadError if
+                                   reject_overload is set.
+        :param handler_timeout:    seconds a coroutine method may run before it is
+                                   cancelled and fails with TimeoutError, even if
+                                   the client waits longer.
+
+        While a connection is over a limit, the server stops reading from it.
+        """
+
+        self._loop = loop or getattr(builder, 'Loop', Loop)()
         self._builder = builder
         self._encodings = (pack_encoding, unpack_encoding)
         self._listeners = []
         self._dispatcher = dispatcher
+        self._registered = {}
+        self._table = None
+        self._executors = {_THREAD: thread_pool, _PROCESS: process_pool}
+        self._owned_executors = []
+        self._gates = {}
+        self._metrics = metrics
+        self._streams = {}   # (sendable, msgid) -> _Stream
+        self._credits = {}   # credit which arrived ahead of its request
+        self._compression = _compression.resolve(compression)
+        self._compress_threshold = compress_threshold
+        self._serializers = serializers or serializer.REGISTRY
+        self._cache = cache
+        if cache is not None:
+            cache._bind(metrics, 'server')
+        self._pending = {}           # (sendable, msgid) -> (responder, task) responded later
+        self._handlers = set()       # running coroutine methods
+        self._waiting_handlers = deque()
+        self._max_async_handlers = max_async_handlers
+        self._handler_timeout = handler_timeout
+        self._reject_overload = reject_overload
+        if max_in_flight is None and max_total_in_flight is None and max_write_buffer is None:
+            self._limits = None
+        else:
+            self._limits = _Limits(max_in_flight, max_total_in_flight, max_write_buffer, reject_overload)
+
+    def register(self, func=None, name=None, validate_args=False):
+        """\
+        Registers func as the method name (func.__name__ by default), replacing
+        a public method of the dispatcher with the same name.  With
+        validate_args, calls with a wrong number of arguments fail with
+        ArgumentError instead of reaching func.  Can be used as a decorator,
+        with or without arguments.
+        """
+
+        if func is None:
+            return lambda func: self.register(func, name, validate_args)
+
+        name = force_str(name or func.__name__)
+        self._registered[name] = (func, validate_args)
+        self._table = None
+        return func
+
+    @property
+    def methods(self):
+        """\
+        Names of the methods clients can call.
+        """
+
+        return sorted(set(force_str(name) for name in self._compile()))
+
+    def _compile(self):
+        if self._table is not None:
+            return self._table
+
+        methods = {}
+        if self._dispatcher is not None:
+            for name, func in _public_methods(self._dispatcher):
+                methods[name] = (func, False)
+        methods.update(self._registered)
+
+        table = {}
+        for name, (func, validate_args) in methods.items():
+            entry = _Method(name, func, validate_args)
+            table[name] = entry
+            table[name.encode('utf-8')] = entry
+        self._table = _freeze(table)
+        return self._table
 
     def listen(self, address):
         listener = self._builder.ServerTransport(address, self._encodings)
         listener.listen(self)
         self._listeners.append(listener)
 
-    def start(self):
-        self._loop.start()
+    def start(self, workers=None, grace_period=10):
+        """\
+        Runs the loop. With workers=N, forks N worker processes which serve the
+        listening sockets, and supervises them until SIGTERM or SIGINT.
+        SIGHUP replaces the workers gracefully.
+        """
+
+        self._compile()
+        if workers:
+            for listener in self._listeners:
+                if not hasattr(listener, 'reopen'):
+                    raise NotImplementedError("the transport does not support workers")
+            prefork.Supervisor(self, workers, grace_period).run()
+        else:
+            self._loop.start()
 
     def stop(self):
         self._loop.stop()
@@ -33,28 +167,511 @@ class Server(session.Session):
     def close(self):
         for listener in self._listeners:
             listener.close()
+        for executor in self._owned_executors:
+            executor.shutdown(wait=False)
+        self._owned_executors = []
+
+    def _after_fork(self):
+        # The loop of the parent must not be shared with the worker
+        self._loop = getattr(self._builder, 'Loop', Loop)()
+        for listener in self._listeners:
+            listener.reopen(self)
+
+    def on_request(self, sendable, msgid, method, param, timeout=None):
+        limits = self._limits
+        if limits is not None and not limits.admit(sendable):
+            if self._metrics is not None:
+                self._metrics.inc('overloads', side='server', method=force_str(method))
+            sendable.send_message([message.RESPONSE, msgid, error.OverloadError("Server is overloaded"), None])
+            return
 
-    def on_request(self, sendable, msgid, method, param):
-        self.dispatch(method, param, _Responder(sendable, msgid))
+        deadline = _deadline(timeout)
+        if self._metrics is not None:
+            self.dispatch(method, param, _MeasuredResponder(sendable, msgid, self._metrics, force_str(method), limits, deadline))
+        else:
+            self.dispatch(method, param, _Responder(sendable, msgid, limits, deadline))
+        if self._credits:
+            self._credits.pop((sendable, msgid), None)
 
     def on_notify(self, method, param):
+        if self._metrics is not None:
+            self._metrics.inc('notifies', side='server', method=force_str(method))
         self.dispatch(method, param, _NullResponder())
 
+    def on_handshake(self, sendable, options):
+        """\
+        The callback called when a client sends the options of its connection.
+        Called by the transport layer.
+        """
+
+        offered = [force_str(name) for name in options.get('compression') or []]
+        codec = _compression.negotiate(offered, self._compression)
+        sendable.handshake({'compression': codec, 'deadlines': True})
+        # The answer itself is not compressed
+        sendable.flush()
+        sendable.set_codec(codec, self._compress_threshold)
+
+    def on_credit(self, sendable, msgid, credit):
+        """\
+        The callback called when the client grants credit to a stream.
+        Called by the transport layer.
+        """
+
+        key = (sendable, msgid)
+        stream = self._streams.get(key)
+        if stream is not None:
+            stream.add_credit(credit)
+        else:
+            self._credits[key] = self._credits.get(key, 0) + credit
+
+    def on_close(self, sendable):
+        """\
+        The callback called when a connection is closed.
+        Called by the transport layer.
+        """
+
+        if self._limits is not None:
+            self._limits.forget(sendable)
+        for key in [key for key in self._streams if key[0] is sendable]:
+            self._streams[key].cancel()
+        for key in [key for key in self._credits if key[0] is sendable]:
+            del self._credits[key]
+        for key in [key for key in self._pending if key[0] is sendable]:
+            self._abandon(key)
+
     def dispatch(self, method, param, responder):
+        if self._cache is not None:
+            responder = self._cached(method, param, responder)
+            if responder is None:
+                return
+
         try:
-            method = force_str(method)
-            if not hasattr(self._dispatcher, method):
-                raise error.NoMethodError("'{0}' method not found".format(method))
+            table = self._table
+            if table is None:
+                table = self._compile()
+            entry = table.get(method)
+            if entry is None:
+                raise error.NoMethodError("'{0}' method not found".format(force_str(method)))
 
-            result = getattr(self._dispatcher, method)(*param)
+            if entry.arity is not None:
+                entry.check(param)
+            if entry.route is not None:
+                self._submit(entry.name, entry.func, param, responder, *entry.route)
+                return
+
+            result = entry.func(*param)
             if isinstance(result, AsyncResult):
                 result.set_responder(responder)
+                self._track(responder, None)
+            elif _is_stream(result):
+                self._start_stream(result, responder)
+            elif _is_coroutine(result):
+                self._start_handler(result, responder)
             else:
                 responder.set_result(result)
         except Exception as e:
             responder.set_error(str(e))
 
-        # TODO: Support advanced and async return
+    def _track(self, responder, task):
+        # Until it is responded, the request is dropped (and task cancelled) with its connection
+        if isinstance(responder, _Responder) and not responder._sent:
+            responder._pending = self._pending
+            self._pending[(responder._sendable, responder._msgid)] = (responder, task)
+
+    def _abandon(self, key):
+        responder, task = self._pending.pop(key)
+        if task is not None:
+            task.cancel()
+        responder.discard()
+
+    def _start_handler(self, coroutine, responder):
+        handler = _Handler(self, coroutine, responder)
+        self._track(responder, handler)
+        if self._max_async_handlers is None or len(self._handlers) < self._max_async_handlers:
+            self._handlers.add(handler)
+            handler.start()
+        elif self._reject_overload:
+            handler.cancel()
+            responder.set_error(error.OverloadError("Too many async handlers"))
+        else:
+            self._waiting_handlers.append(handler)
+
+    def _on_handler_done(self, handler):
+        self._handlers.discard(handler)
+        if self._waiting_handlers:
+            handler = self._waiting_handlers.popleft()
+            self._handlers.add(handler)
+            handler.start()
+
+    def _cached(self, method, param, responder):
+        """\
+        Responds from the cache, or returns the responder which fills it.
+        """
+
+        cache = self._cache
+        key = cache.key(method, param)
+        if key is None:
+            return responder
+
+        state, result = cache.fetch(key)
+        if state == _cache.MISS:
+            return _CachingResponder(responder, cache, key)
+        if state == _cache.HIT:
+            responder.set_result(result)
+        else:
+            cache.wait(key, lambda result, error: responder.set_result(result, error))
+        return None
+
+    def _start_stream(self, generator, responder):
+        key = (getattr(responder, '_sendable', None), getattr(responder, '_msgid', None))
+        credit = self._credits.pop(key, None)
+        stream = _Stream(self, key, generator, responder, credit)
+        if credit is not None:
+            self._streams[key] = stream
+        stream.pump()
+
+    def _executor(self, kind):
+        executor = self._executors[kind]
+        if executor is None:
+            from concurrent import futures
+            if kind == _THREAD:
+                executor = futures.ThreadPoolExecutor(max_workers=_DEFAULT_THREADS)
+            else:
+                executor = futures.ProcessPoolExecutor()
+            self._executors[kind] = executor
+            self._owned_executors.append(executor)
+        return executor
+
+    def _submit(self, method, func, param, responder, kind, limit):
+        gate = self._gates.get(method)
+        if gate is None:
+            gate = self._gates[method] = _Gate(limit)
+
+        if gate.running >= gate.limit:
+            gate.queue.append((func, param, responder, kind))
+        else:
+            self._run_in_executor(gate, func, param, responder, kind)
+
+    def _run_in_executor(self, gate, func, param, responder, kind):
+        gate.running += 1
+        try:
+            future = self._executor(kind).submit(func, *param)
+        except Exception as e:
+            gate.running -= 1
+            responder.set_error(str(e))
+            return
+
+        # Executor callbacks run on the worker thread; move back to the loop
+        future.add_done_callback(
+            lambda f: self._loop.add_callback(lambda: self._on_executed(gate, f, responder)))
+
+    def _on_executed(self, gate, future, responder):
+        gate.running -= 1
+        if gate.queue:
+            self._run_in_executor(gate, *gate.queue.popleft())
+
+        exception = future.exception()
+        if exception is not None:
+            responder.set_error(str(exception))
+        else:
+            responder.set_result(future.result())
+
+
+try:
+    _StopAsyncIteration = StopAsyncIteration
+except NameError:
+    # Python < 3.5
+    _StopAsyncIteration = StopIteration
+
+
+def _is_stream(result):
+    return inspect.isgenerator(result) or (hasattr(inspect, 'isasyncgen') and inspect.isasyncgen(result))
+
+
+def _is_coroutine(result):
+    return hasattr(inspect, 'iscoroutine') and inspect.iscoroutine(result)
+
+
+def _deadline(timeout):
+    # The timeout of a request comes from the client; ignore anything else than seconds
+    if isinstance(timeout, (int, float)) and not isinstance(timeout, bool) and timeout > 0:
+        return time.time() + timeout
+    return None
+
+
+class _Handler(object):
+    """\
+    A coroutine method running on the loop of the server.
+    """
+
+    def __init__(self, server, coroutine, responder):
+        self._server = server
+        self._coroutine = coroutine
+        self._responder = responder
+        self._future = None
+        self._timer = None
+        self._done = False
+
+    def start(self):
+        loop = self._server._loop
+        timeout = self._server._handler_timeout
+        deadline = getattr(self._responder, '_deadline', None)
+        if deadline is not None:
+            remaining = max(0, deadline - time.time())
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if timeout is not None:
+            self._timer = loop.add_timeout(timeout, self._on_timeout)
+        self._future = loop.spawn(self._coroutine)
+        self._future.add_done_callback(self._on_done)
+
+    def cancel(self):
+        """\
+        Stops the coroutine without responding.
+        """
+
+        if self._done:
+            return
+        self._done = True
+        self._stop_timer()
+        if self._future is None:
+            # Never started; close it so that it is not reported as never awaited
+            if self in self._server._waiting_handlers:
+                self._server._waiting_handlers.remove(self)
+            self._coroutine.close()
+        else:
+            self._future.cancel()
+            self._server._on_handler_done(self)
+
+    def _on_timeout(self):
+        self._timer = None
+        if not self._done:
+            self.cancel()
+            self._responder.set_error(error.TimeoutError("Handler timed out"))
+
+    def _on_done(self, future):
+        if self._done:
+            # Cancelled; retrieve the CancelledError so that it is not logged
+            if not future.cancelled():
+                future.exception()
+            return
+        self._done = True
+        self._stop_timer()
+        self._server._on_handler_done(self)
+        try:
+            result = future.result()
+        except Exception as e:
+            self._responder.set_error(str(e))
+        else:
+            self._responder.set_result(result)
+
+    def _stop_timer(self):
+        if self._timer is not None:
+            self._server._loop.remove_timeout(self._timer)
+            self._timer = None
+
+
+class _Stream(object):
+    """\
+    Sends the chunks of a generator as STREAM messages while the client has
+    credit, then the end of the stream as the response.  Without credit (a
+    plain call), collects the chunks into the response instead.
+    """
+
+    def __init__(self, server, key, generator, responder, credit):
+        self._server = server
+        self._key = key
+        self._generator = generator
+        self._responder = responder
+        self._credit = credit
+        self._chunks = [] if credit is None else None
+        self._async = not inspect.isgenerator(generator)
+        self._running = False
+        self._done = False
+
+    def add_credit(self, credit):
+        if credit < 0:
+            self.cancel()
+        else:
+            self._credit += credit
+            self.pump()
+
+    def pump(self):
+        while not self._done and not self._running and (self._credit is None or self._credit > 0):
+            if self._async:
+                self._running = True
+                self._server._loop.spawn(self._generator.__anext__()).add_done_callback(self._on_next)
+                return
+
+            try:
+                chunk = next(self._generator)
+            except StopIteration:
+                self._finish()
+                return
+            except Exception as e:
+                self._finish(e)
+                return
+            self._send(chunk)
+
+    def _on_next(self, future):
+        self._running = False
+        if self._done:
+            # Cancelled while producing the chunk
+            self._server._loop.spawn(self._generator.aclose())
+            return
+
+        try:
+            chunk = future.result()
+        except _StopAsyncIteration:
+            self._finish()
+            return
+        except Exception as e:
+            self._finish(e)
+            return
+        self._send(chunk)
+        # Not from within the callback, which may run while spawning
+        self._server._loop.add_callback(self.pump)
+
+    def _send(self, chunk):
+        if self._chunks is not None:
+            self._chunks.append(chunk)
+        else:
+            self._credit -= 1
+            self._responder._sendable.send_message([message.STREAM, self._responder._msgid, None, chunk])
+
+    def _finish(self, exception=None):
+        self._done = True
+        self._server._streams.pop(self._key, None)
+        if exception is not None:
+            self._responder.set_error(str(exception))
+        else:
+            self._responder.set_result(self._chunks)
+
+    def cancel(self):
+        if self._done:
+            return
+
+        self._done = True
+        self._server._streams.pop(self._key, None)
+        if not self._async:
+            self._generator.close()
+        elif not self._running:
+            self._server._loop.spawn(self._generator.aclose())
+        # Releases the limits; the client already forgot the msgid
+        self._responder.set_result(None)
+
+
+class _Method(object):
+    """\
+    Entry of the method table.
+    """
+
+    __slots__ = ('name', 'func', 'route', 'arity')
+
+    def __init__(self, name, func, validate_args):
+        self.name = name
+        self.func = func
+        self.route = getattr(func, '_msgpackrpc_executor', None)
+        self.arity = _arity(func) if validate_args else None
+
+    def check(self, param):
+        low, high = self.arity
+        if len(param) < low or (high is not None and len(param) > high):
+            if high is None:
+                expected = "at least {0}".format(low)
+            elif low == high:
+                expected = str(low)
+            else:
+                expected = "{0} to {1}".format(low, high)
+            raise error.ArgumentError("'{0}' takes {1} arguments ({2} given)".format(self.name, expected, len(param)))
+
+
+def _arity(func):
+    """\
+    Returns (minimum, maximum) number of positional arguments of func, where
+    maximum is None for *args.
+    """
+
+    try:
+        signature = inspect.signature(func)
+    except AttributeError:
+        # Python 2
+        spec = inspect.getargspec(func)
+        args = spec.args[1:] if inspect.ismethod(func) else spec.args
+        low = len(args) - len(spec.defaults or ())
+        return low, None if spec.varargs else len(args)
+
+    low = high = 0
+    for parameter in signature.parameters.values():
+        if parameter.kind == parameter.VAR_POSITIONAL:
+            high = None
+        elif parameter.kind in (parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD):
+            if parameter.default is parameter.empty:
+                low += 1
+            if high is not None:
+                high += 1
+    return low, high
+
+
+def _public_methods(dispatcher):
+    cls = type(dispatcher)
+    for name in dir(dispatcher):
+        if name.startswith('_'):
+            continue
+        # Do not evaluate properties and other descriptors
+        attr = getattr(cls, name, None)
+        if attr is not None and not callable(attr) and hasattr(attr, '__get__'):
+            continue
+        func = getattr(dispatcher, name)
+        if callable(func) and not inspect.isclass(func):
+            yield name, func
+
+
+def _freeze(table):
+    try:
+        from types import MappingProxyType
+    except ImportError:
+        # Python 2
+        return table
+    return MappingProxyType(table)
+
+
+_THREAD = 'thread'
+_PROCESS = 'process'
+_DEFAULT_THREADS = 16
+
+
+def run_in_thread_pool(limit=None):
+    """\
+    Marks a dispatcher method to run in the thread pool of the Server instead of
+    the loop thread, for blocking methods.  At most limit calls of the method
+    run at the same time; the others wait in order.
+    """
+
+    return _route(_THREAD, limit)
+
+
+def run_in_process_pool(limit=None):
+    """\
+    Marks a dispatcher method to run in the process pool of the Server, for
+    CPU-bound methods.  The dispatcher and the arguments must be picklable.
+    At most limit calls of the method run at the same time.
+    """
+
+    return _route(_PROCESS, limit)
+
+
+def _route(kind, limit):
+    def decorator(func):
+        func._msgpackrpc_executor = (kind, limit)
+        return func
+    return decorator
+
+
+class _Gate(object):
+    def __init__(self, limit):
+        self.limit = limit if limit is not None else float('inf')
+        self.running = 0
+        self.queue = deque()
 
 
 class AsyncResult:
@@ -78,20 +695,154 @@ class AsyncResult:
             self._result = None
 
 
+class _Limits(object):
+    """\
+    Counts the requests in flight and pauses reading from the connections
+    which are over a limit, until they are under all limits again.
+    """
+
+    def __init__(self, per_connection, total, write_buffer, reject):
+        self.per_connection = per_connection
+        self.total = total
+        self.write_buffer = write_buffer
+        self.reject = reject
+        self.in_flight = 0
+        self._paused = set()
+        self._draining = set()
+
+    def admit(self, sock):
+        """\
+        Accounts a request of sock.  Returns False if it must be rejected.
+        """
+
+        if self.reject and self._full(sock):
+            return False
+
+        sock._in_flight += 1
+        self.in_flight += 1
+        if self._over(sock):
+            self._pause(sock)
+        return True
+
+    def release(self, sock):
+        sock._in_flight -= 1
+        self.in_flight -= 1
+        if sock in self._paused:
+            self._resume(sock)
+        if self._paused and (self.total is None or self.in_flight < self.total):
+            for paused in list(self._paused):
+                self._resume(paused)
+
+    def forget(self, sock):
+        self._paused.discard(sock)
+        self._draining.discard(sock)
+
+    def _full(self, sock):
+        return ((self.per_connection is not None and sock._in_flight >= self.per_connection) or
+                (self.total is not None and self.in_flight >= self.total))
+
+    def _over(self, sock):
+        # With reject, the in-flight limits are enforced by rejecting
+        return ((not self.reject and self._full(sock)) or
+                (self.write_buffer is not None and sock.write_buffer_size() > self.write_buffer))
+
+    def _pause(self, sock):
+        if sock not in self._paused:
+            self._paused.add(sock)
+            sock.pause_reading()
+        if self.write_buffer is not None and sock.write_buffer_size() > self.write_buffer:
+            if sock not in self._draining:
+                self._draining.add(sock)
+                sock.on_drained(lambda: self._on_drained(sock))
+
+    def _on_drained(self, sock):
+        self._draining.discard(sock)
+        if sock in self._paused:
+            self._resume(sock)
+
+    def _resume(self, sock):
+        if sock.closed():
+            self.forget(sock)
+        elif self._over(sock):
+            self._pause(sock)
+        else:
+            self._paused.discard(sock)
+            sock.resume_reading()
+
+
 class _Responder:
-    def __init__(self, sendable, msgid):
+    # Server._pending while the request is tracked
+    _pending = None
+
+    def __init__(self, sendable, msgid, limits=None, deadline=None):
         self._sendable = sendable
         self._msgid = msgid
+        self._limits = limits
+        self._deadline = deadline
         self._sent = False
 
     def set_result(self, value, error=None, packer=msgpack.Packer()):
         if not self._sent:
             self._sendable.send_message([message.RESPONSE, self._msgid, error, value])
-            self._sent = True
+            self._release()
 
     def set_error(self, error, value=None):
         self.set_result(value, error)
 
+    def discard(self):
+        """\
+        Forgets the request without responding, e.g. once its connection is closed.
+        """
+
+        if not self._sent:
+            self._release()
+
+    def _release(self):
+        self._sent = True
+        if self._pending is not None:
+            self._pending.pop((self._sendable, self._msgid), None)
+        if self._limits is not None:
+            self._limits.release(self._sendable)
+
+
+class _CachingResponder(object):
+    def __init__(self, responder, cache, key):
+        self._responder = responder
+        self._cache = cache
+        self._key = key
+
+    def set_result(self, value, error=None):
+        self._responder.set_result(value, error)
+        self._cache.complete(self._key, value, error)
+
+    def set_error(self, error, value=None):
+        self.set_result(value, error)
+
+
+class _MeasuredResponder(_Responder):
+    def __init__(self, sendable, msgid, metrics, method, limits=None, deadline=None):
+        _Responder.__init__(self, sendable, msgid, limits, deadline)
+        self._metrics = metrics
+        self._method = method
+        self._started = time.time()
+        metrics.inc('requests', side='server', method=method)
+        metrics.add_gauge('in_flight', 1, side='server')
+
+    def set_result(self, value, error=None):
+        if not self._sent:
+            metrics = self._metrics
+            metrics.add_gauge('in_flight', -1, side='server')
+            if error is not None:
+                metrics.inc('errors', side='server', method=self._method)
+            metrics.observe('request_seconds', time.time() - self._started, side='server', method=self._method)
+        _Responder.set_result(self, value, error)
+
+    def discard(self):
+        if not self._sent:
+            self._metrics.add_gauge('in_flight', -1, side='server')
+            self._metrics.inc('cancels', side='server', method=self._method)
+        _Responder.discard(self)
+
 
 class _NullResponder:
     def set_result(self, value, error=None):
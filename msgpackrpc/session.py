@@ -1,9 +1,26 @@
+from collections import deque
+import itertools
+import time
+
 from msgpackrpc import Loop
+from msgpackrpc import cache as _cache
+from msgpackrpc import compression as _compression
 from msgpackrpc import message
-from msgpackrpc.future import Future
+from msgpackrpc import serializer
+from msgpackrpc.future import Future, MultiFuture, Stream
+from msgpackrpc.timer import TimerWheel
 from msgpackrpc.transport import tcp
-from msgpackrpc.compat import iteritems
-from msgpackrpc.error import TimeoutError
+from msgpackrpc.compat import force_str, iteritems
+from msgpackrpc.error import OverloadError, TimeoutError, TransportError
+
+
+# Admission modes of requests over max_outstanding
+BLOCK = 'block'
+WAIT = 'wait'
+FAIL = 'fail'
+
+# Chunks of a streaming call the server may send ahead of the consumer
+DEFAULT_WINDOW = 16
 
 
 class Session(object):
@@ -17,51 +34,280 @@ class Session(object):
 
     When it receives the message, the Session lookups the request table and set the
     result to the corresponding future.
+
+    self._timer(timer wheel) keeps the deadline of each message id which has a
+    timeout, so that step_timeout only visits the requests which actually expired.
+
+    With max_outstanding, at most that many requests wait for their response.
+    A request over the limit is admitted by the admission mode:
+    BLOCK runs the loop until a response frees a slot (or waits like WAIT if the
+    loop is already running), WAIT queues it unsent and returns its Future at
+    once, and FAIL sets OverloadError to its Future.  The timeout of a queued
+    request starts when it is sent.
+
+    When the server accepts deadlines, a request with a timeout carries it, so
+    that the server can give up on it as well.
     """
 
-    def __init__(self, address, timeout, loop=None, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None):
+    def __init__(self, address, timeout, loop=None, builder=tcp, reconnect_limit=5, pack_encoding='utf-8', unpack_encoding=None,
+                 metrics=None, max_outstanding=None, admission=BLOCK, compression=None, compress_threshold=1024,
+                 serializers=None, cache=None):
         """\
         :param address: address of the server.
+        :param timeout: default timeout of each request in seconds (float is allowed).
         :param loop:    context object.
-        :param builder: builder for creating transport layer
+        :param builder: builder for creating transport layer; its Loop class, if any, is
+                        used when no loop is given
+        :param metrics: msgpackrpc.metrics.Metrics which records the calls, or None.
+        :param max_outstanding: limit of requests waiting for the response, or None.
+        :param admission:       BLOCK, WAIT or FAIL; what to do with requests over the limit.
+        :param compression:        codecs offered to the server; see msgpackrpc.compression.
+        :param compress_threshold: batches of this many bytes or more are compressed.
+        :param serializers: msgpackrpc.serializer.Registry of the extension types;
+                            serializer.REGISTRY by default.
+        :param cache:   msgpackrpc.cache.ResultCache of call and call_async, or None.
         """
 
-        self._loop = loop or Loop()
+        if admission not in (BLOCK, WAIT, FAIL):
+            raise ValueError("Unknown admission: {0}".format(admission))
+
+        self._loop = loop or getattr(builder, 'Loop', Loop)()
         self._address = address
         self._timeout = timeout
+        self._metrics = metrics
+        self._started = {}
+        self._compression = _compression.resolve(compression)
+        self._compress_threshold = compress_threshold
+        self._serializers = serializers or serializer.REGISTRY
+        self._cache = cache
+        if cache is not None:
+            cache._bind(metrics, 'client')
         self._transport = builder.ClientTransport(self, self._address, reconnect_limit, encodings=(pack_encoding, unpack_encoding))
-        self._generator = _NoSyncIDGenerator()
+        self._generator = _IDGenerator()
         self._request_table = {}
+        self._timer = TimerWheel(now=time.time())
+        self._max_outstanding = max_outstanding
+        self._admission = admission
+        self._parked = deque()
+        self._admission_waiters = []
+        self._blocked = False
+        self._streams = {}
 
     @property
     def address(self):
         return self._address
 
-    def call(self, method, *args):
-        return self.send_request(method, args).get()
+    def call(self, method, *args, **options):
+        """\
+        Calls method and waits for the result.
+        Pass timeout=seconds to override the default timeout of the session.
+        """
+        return self.send_request(method, args, _timeout_option(options)).get()
 
-    def call_async(self, method, *args):
-        return self.send_request(method, args)
+    def call_async(self, method, *args, **options):
+        """\
+        Calls method and returns the Future of the result.
+        Pass timeout=seconds to override the default timeout of the session.
+        """
+        return self.send_request(method, args, _timeout_option(options))
+
+    def call_batch(self, calls, timeout=None):
+        """\
+        Sends the calls, a sequence of (method, args), in one write and returns
+        the MultiFuture of their results.
+        """
+
+        futures = []
+        messages = []
+        for method, args in calls:
+            if self._max_outstanding is not None and not self._has_slot():
+                futures.append(self._overflow(method, args, timeout, block=False))
+                continue
+            request, future = self._register_request(method, args, timeout)
+            futures.append(future)
+            messages.append(request)
+
+        self._send_messages(messages)
+        return MultiFuture(self._loop, futures)
+
+    def call_stream(self, method, *args, **options):
+        """\
+        Calls method, which returns a generator on the server, and returns the
+        Stream of its chunks.  Pass window=n to let the server send up to n
+        chunks ahead of the consumer.
+        """
+
+        window = options.pop('window', DEFAULT_WINDOW)
+        if options:
+            raise TypeError("unexpected keyword arguments: {0}".format(', '.join(options)))
 
-    def send_request(self, method, args):
-        # need lock?
         msgid = next(self._generator)
-        future = Future(self._loop, self._timeout)
-        self._request_table[msgid] = future
-        self._transport.send_message([message.REQUEST, msgid, method, args])
+        stream = Stream(self, msgid, window)
+        self._streams[msgid] = stream
+        # The credit comes first, so that the server streams instead of collecting
+        self._send_messages([[message.CREDIT, msgid, window], [message.REQUEST, msgid, method, args]])
+        return stream
+
+    def _send_messages(self, messages):
+        send_messages = getattr(self._transport, 'send_messages', None)
+        if messages and send_messages is not None:
+            send_messages(messages)
+        else:
+            for request in messages:
+                self._transport.send_message(request)
+
+    def _send_credit(self, msgid, credit):
+        if self._transport is not None:
+            self._transport.send_message([message.CREDIT, msgid, credit])
+
+    def _cancel_stream(self, msgid):
+        if self._streams.pop(msgid, None) is not None:
+            self._send_credit(msgid, -1)
+
+    def map(self, method, iterable, timeout=None):
+        """\
+        Calls method once for each tuple of arguments in iterable, as one batch,
+        and returns the list of results in order.
+        """
+
+        return self.call_batch([(method, args) for args in iterable], timeout).get()
+
+    def send_request(self, method, args, timeout=None):
+        if self._cache is not None:
+            key = self._cache.key(method, args)
+            if key is not None:
+                return self._send_cached_request(key, method, args, timeout)
+        return self._send_request(method, args, timeout)
+
+    def _send_cached_request(self, key, method, args, timeout):
+        cache = self._cache
+        state, result = cache.fetch(key)
+        if state == _cache.MISS:
+            future = self._send_request(method, args, timeout)
+            future.add_done_callback(lambda f: cache.complete(key, f._result, f._error))
+            return future
+
+        future = Future(self._loop, timeout)
+        if state == _cache.HIT:
+            future.set_result(result)
+        else:
+            cache.wait(key, lambda result, error: future.set_result(result) if error is None else future.set_error(error))
         return future
 
+    def _send_request(self, method, args, timeout=None):
+        if self._max_outstanding is not None and not self._has_slot():
+            future = self._overflow(method, args, timeout)
+            if future is not None:
+                return future
+
+        request, future = self._register_request(method, args, timeout)
+        self._transport.send_message(request)
+        return future
+
+    def admission(self):
+        """\
+        Returns a Future which is set once a request would be sent at once.
+        Await or join it to pace a producer under max_outstanding.
+        """
+
+        future = Future(self._loop, None)
+        if self._max_outstanding is None or self._has_slot():
+            future.set_result(None)
+        else:
+            self._admission_waiters.append(future)
+        return future
+
+    def _has_slot(self):
+        return not self._parked and len(self._request_table) < self._max_outstanding
+
+    def _overflow(self, method, args, timeout, block=True):
+        """\
+        Admits a request over max_outstanding.  Returns its Future, or None
+        once a slot is free to send it.
+        """
+
+        if self._admission == FAIL:
+            future = Future(self._loop, timeout)
+            future.set_error(OverloadError("Too many outstanding requests"))
+            return future
+
+        if block and self._admission == BLOCK and not self._loop.running():
+            self._blocked = True
+            try:
+                while not self._has_slot() and self._transport is not None:
+                    self._loop.start()
+            finally:
+                self._blocked = False
+            if self._has_slot():
+                return None
+
+        future = Future(self._loop, timeout)
+        self._parked.append((method, args, timeout, future))
+        return future
+
+    def _release(self):
+        # Sends the queued requests, then wakes up the waiters, as slots are freed
+        while self._parked and len(self._request_table) < self._max_outstanding:
+            method, args, timeout, future = self._parked.popleft()
+            request, future = self._register_request(method, args, timeout, future)
+            self._transport.send_message(request)
+
+        if self._has_slot():
+            if self._blocked:
+                self._loop.stop()
+            waiters, self._admission_waiters = self._admission_waiters, []
+            for waiter in waiters:
+                waiter.set_result(None)
+
+    def _register_request(self, method, args, timeout, future=None):
+        """\
+        Returns the REQUEST message and its Future.
+        """
+
+        msgid = next(self._generator)
+        if timeout is None:
+            timeout = self._timeout
+        if future is None:
+            future = Future(self._loop, timeout)
+        self._request_table[msgid] = future
+        if timeout:
+            self._timer.arm(msgid, timeout)
+        if self._metrics is not None:
+            method = force_str(method)
+            self._started[msgid] = (method, time.time())
+            self._metrics.inc('requests', side='client', method=method)
+            self._metrics.add_gauge('in_flight', 1, side='client')
+        if timeout and self._transport.deadlines:
+            return [message.REQUEST, msgid, method, args, timeout], future
+        return [message.REQUEST, msgid, method, args], future
+
     def notify(self, method, *args):
         def callback():
             self._loop.stop()
-        self._transport.send_message([message.NOTIFY, method, args], callback=callback)
+        self._send_notify(method, args, callback)
         self._loop.start()
 
+    def _send_notify(self, method, args, callback=None):
+        if self._metrics is not None:
+            self._metrics.inc('notifies', side='client', method=force_str(method))
+        self._transport.send_message([message.NOTIFY, method, args], callback=callback)
+
     def close(self):
         if self._transport:
             self._transport.close()
         self._transport = None
         self._request_table = {}
+        self._timer = TimerWheel(now=time.time())
+        self._forget_started()
+        self._parked = deque()
+        if self._blocked:
+            self._loop.stop()
+        streams, self._streams = self._streams, {}
+        for stream in streams.values():
+            stream.on_end(TransportError("Session closed"))
+        waiters, self._admission_waiters = self._admission_waiters, []
+        for waiter in waiters:
+            waiter.set_result(None)
 
     def on_connect_failed(self, reason):
         """
@@ -70,9 +316,17 @@ class Session(object):
         """
         # set error for all requests
         for msgid, future in iteritems(self._request_table):
+            self._finish(msgid, True)
             future.set_error(reason)
+        parked, self._parked = self._parked, deque()
+        for method, args, timeout, future in parked:
+            future.set_error(reason)
+        streams, self._streams = self._streams, {}
+        for stream in streams.values():
+            stream.on_end(reason)
 
         self._request_table = {}
+        self._timer = TimerWheel(now=time.time())
         self.close()
         self._loop.stop()
 
@@ -82,48 +336,105 @@ class Session(object):
         Called by the transport layer.
         """
 
+        if self._streams:
+            stream = self._streams.pop(msgid, None)
+            if stream is not None:
+                stream.on_end(error)
+                return
+
         if not msgid in self._request_table:
             # TODO: Check timed-out msgid?
             #raise RPCError("Unknown msgid: id = {0}".format(msgid))
             return
         future = self._request_table.pop(msgid)
+        self._timer.cancel(msgid)
+        if self._metrics is not None:
+            self._finish(msgid, error is not None)
 
         if error is not None:
             future.set_error(error)
         else:
             future.set_result(result)
-        self._loop.stop()
+
+        if self._max_outstanding is not None:
+            self._release()
+
+    def on_stream(self, msgid, error, chunk):
+        """\
+        The callback called when a chunk of a streaming call arrives.
+        Called by the transport layer.
+        """
+
+        stream = self._streams.get(msgid)
+        if stream is not None:
+            stream.on_chunk(chunk)
 
     def on_timeout(self, msgid):
         future = self._request_table.pop(msgid)
         future.set_error("Request timed out")
 
     def step_timeout(self):
-        timeouts = []
-        for msgid, future in iteritems(self._request_table):
-            if future.step_timeout():
-                timeouts.append(msgid)
+        """\
+        Expires the requests whose deadline passed.
+        Called periodically, once per tick of the timer wheel.
+        """
 
+        timeouts = self._timer.advance(time.time())
         if len(timeouts) == 0:
             return
 
-        self._loop.stop()
         for timeout in timeouts:
-            future = self._request_table.pop(timeout)
-            future.set_error(TimeoutError("Request timed out"))
-        self._loop.start()
+            future = self._request_table.pop(timeout, None)
+            if future is not None:
+                if self._metrics is not None:
+                    self._finish(timeout, True, 'timeouts')
+                future.set_error(TimeoutError("Request timed out"))
+
+        if self._max_outstanding is not None:
+            self._release()
+
+    def _finish(self, msgid, failed, reason='errors'):
+        started = self._started.pop(msgid, None)
+        if started is None:
+            return
+
+        method, start = started
+        self._metrics.add_gauge('in_flight', -1, side='client')
+        if failed:
+            self._metrics.inc(reason, side='client', method=method)
+        else:
+            self._metrics.observe('request_seconds', time.time() - start, side='client', method=method)
+
+    def _forget_started(self):
+        if self._started:
+            self._metrics.add_gauge('in_flight', -len(self._started), side='client')
+            self._started = {}
+
+
+def _timeout_option(options):
+    timeout = options.pop('timeout', None)
+    if options:
+        raise TypeError("unexpected keyword arguments: {0}".format(', '.join(options)))
+    return timeout
 
 
-def _NoSyncIDGenerator():
+class _IDGenerator(object):
     """
     Message ID Generator.
 
-    NOTE: Don't use in multithread. If you want use this
-    in multithreaded application, use lock.
+    next() is atomic (itertools.count is implemented in C), so the generator
+    may be shared by threads without a lock.
     """
-    counter = 0
-    while True:
-        yield counter
-        counter += 1
-        if counter > (1 << 30):
-            counter = 0
+
+    MASK = (1 << 30) - 1
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._counter) & self.MASK
+
+    next = __next__
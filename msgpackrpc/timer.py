@@ -0,0 +1,76 @@
+import math
+
+
+class TimerWheel(object):
+    """\
+    Hashed timing wheel which tracks deadlines of in-flight requests.
+
+    Keys are armed into the slot of the tick on which they expire, so arm()
+    and cancel() are O(1) and advance() only touches the slots of the
+    elapsed ticks.  Timeouts longer than one revolution of the wheel stay in
+    their slot until the wheel comes around to them again.
+    """
+
+    def __init__(self, tick=0.1, slots=512, now=0.0):
+        """\
+        :param tick:  granularity of the wheel in seconds.
+        :param slots: number of slots; tick * slots should cover the usual timeout.
+        :param now:   current time, in the same unit as the values given to advance().
+        """
+
+        self._tick = tick
+        self._slots = [{} for _ in range(slots)]
+        self._index = {}
+        self._current = int(now / tick)
+
+    @property
+    def tick(self):
+        return self._tick
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def arm(self, key, timeout):
+        """\
+        Schedules key to expire after timeout seconds. Re-arming a key replaces
+        the previous deadline.
+        """
+
+        self.cancel(key)
+        expire = self._current + max(1, int(math.ceil(timeout / self._tick)))
+        slot = self._slots[expire % len(self._slots)]
+        slot[key] = expire
+        self._index[key] = slot
+
+    def cancel(self, key):
+        slot = self._index.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def advance(self, now):
+        """\
+        Moves the wheel forward to now and returns the keys which expired.
+        """
+
+        target = int(now / self._tick)
+        if target - self._current > len(self._slots):
+            # Fell behind by more than a revolution; every slot is due.
+            self._current = target - len(self._slots)
+
+        expired = []
+        while self._current < target:
+            self._current += 1
+            slot = self._slots[self._current % len(self._slots)]
+            if not slot:
+                continue
+
+            keys = [key for key, expire in slot.items() if expire <= self._current]
+            for key in keys:
+                del slot[key]
+                del self._index[key]
+            expired.extend(keys)
+
+        return expired
@@ -0,0 +1,413 @@
+"""\
+Transport layer built on asyncio (and uvloop when it is installed).
+
+Pass this module as the builder of Client or Server.  Unless an explicit
+loop is given, the Client/Server then runs on a new asyncio event loop.  To
+share the loop of an asyncio application, pass Loop(asyncio.get_event_loop())
+and await the futures returned by call_async instead of calling get().
+
+A UnixAddress is served over a Unix domain socket.
+
+Builder(zero_copy=True, bin_view_threshold=N) decodes the messages in place
+from the receive buffer, and returns bin fields of N bytes or more as
+memoryviews into it.
+"""
+
+import asyncio
+import socket
+
+from msgpackrpc import framing
+from msgpackrpc.address import UnixAddress
+from msgpackrpc.transport import tcp
+
+
+try:
+    _Protocol = asyncio.BufferedProtocol
+except AttributeError:
+    _Protocol = asyncio.Protocol
+
+
+def _new_event_loop():
+    try:
+        import uvloop
+        return uvloop.new_event_loop()
+    except ImportError:
+        return asyncio.new_event_loop()
+
+
+class Loop(object):
+    """\
+    An I/O loop class which wraps the asyncio's event loop.
+    """
+
+    @staticmethod
+    def instance():
+        return Loop(asyncio.get_event_loop())
+
+    def __init__(self, loop=None):
+        self._loop = loop or _new_event_loop()
+        self._periodic_callback = None
+        self._started = False
+
+    def start(self):
+        """\
+        Runs the event loop until stop() is called, if it's not running.
+        """
+
+        if not self._loop.is_running():
+            self._started = True
+            try:
+                self._loop.run_forever()
+            finally:
+                self._started = False
+
+    def running(self):
+        return self._loop.is_running()
+
+    def stop(self):
+        """\
+        Stops the event loop if it was started by start().
+        A loop run by the application is never stopped.
+        """
+
+        if self._started:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def add_callback(self, callback):
+        """\
+        Calls callback on the next iteration. Safe to call from other threads.
+        """
+
+        self._loop.call_soon_threadsafe(callback)
+
+    def add_callback_from_signal(self, callback):
+        self._loop.call_soon_threadsafe(callback)
+
+    def add_timeout(self, delay, callback):
+        """\
+        Calls callback after delay seconds. Returns the handle for remove_timeout().
+        """
+
+        return self._loop.call_later(delay, callback)
+
+    def remove_timeout(self, handle):
+        handle.cancel()
+
+    def create_future(self):
+        return self._loop.create_future()
+
+    def spawn(self, awaitable):
+        """\
+        Runs the coroutine (or other awaitable) on the loop. Returns its Task.
+        """
+
+        return asyncio.ensure_future(awaitable, loop=self._loop)
+
+    def attach_periodic_callback(self, callback, callback_time):
+        if self._periodic_callback is not None:
+            self.dettach_periodic_callback()
+
+        def _run():
+            self._periodic_callback = self._loop.call_later(callback_time / 1000.0, _run)
+            callback()
+        self._periodic_callback = self._loop.call_later(callback_time / 1000.0, _run)
+
+    def dettach_periodic_callback(self):
+        if self._periodic_callback is not None:
+            self._periodic_callback.cancel()
+        self._periodic_callback = None
+
+
+class Builder(object):
+    """\
+    Builder of asyncio transports with receive options.
+    """
+
+    Loop = Loop
+
+    def __init__(self, zero_copy=True, bin_view_threshold=None):
+        """\
+        :param zero_copy:          frame and decode the messages in place in a growable
+                                   receive buffer instead of feeding msgpack.Unpacker.
+        :param bin_view_threshold: with zero_copy, bin fields of this many bytes or more
+                                   are memoryviews into the receive buffer.
+        """
+
+        self._options = {'zero_copy': zero_copy, 'bin_view_threshold': bin_view_threshold}
+
+    def ClientTransport(self, session, address, reconnect_limit, encodings=('utf-8', None)):
+        return ClientTransport(session, address, reconnect_limit, encodings, **self._options)
+
+    def ServerTransport(self, address, encodings=('utf-8', None)):
+        return ServerTransport(address, encodings, **self._options)
+
+
+class BaseSocket(tcp.BaseSocket, _Protocol):
+    """\
+    Protocol which reads into a preallocated buffer and decodes with the same
+    framing as the Tornado transport. self._stream is the asyncio transport.
+    """
+
+    READ_BUFFER_SIZE = 64 * 1024
+
+    def __init__(self, loop, encodings, serializers, zero_copy=False, bin_view_threshold=None):
+        tcp.BaseSocket.__init__(self, None, encodings, serializers)
+        self._loop = loop
+        if zero_copy:
+            self._receive_buffer = framing.ReceiveBuffer(encodings[1], bin_view_threshold, serializers.ext_hook)
+        else:
+            self._receive_buffer = None
+            self._buffer = memoryview(bytearray(self.READ_BUFFER_SIZE))
+        self._writing_paused = False
+        self._drain_callbacks = []
+
+    def close(self):
+        if self._stream is not None:
+            self.flush()
+            self._stream.close()
+
+    def _schedule_flush(self, delay):
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+
+        if delay:
+            if in_loop:
+                self._loop.call_later(delay, self.flush)
+            else:
+                self._loop.call_soon_threadsafe(self._loop.call_later, delay, self.flush)
+        elif in_loop:
+            self._loop.call_soon(self.flush)
+        else:
+            self._loop.call_soon_threadsafe(self.flush)
+
+    def _write(self, data, callbacks):
+        if self._stream.is_closing():
+            return
+
+        self._stream.write(data)
+        for callback in callbacks:
+            self._loop.call_soon(callback)
+
+    def write_buffer_size(self):
+        return self._stream.get_write_buffer_size() if self._stream is not None else 0
+
+    def on_drained(self, callback):
+        """\
+        Calls callback once the write buffer drops below its low-water mark.
+        """
+
+        if self._writing_paused:
+            self._drain_callbacks.append(callback)
+        else:
+            self._loop.call_soon(callback)
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        callbacks, self._drain_callbacks = self._drain_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def connection_made(self, transport):
+        self._stream = transport
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def connection_lost(self, exc):
+        self.on_close()
+
+    def get_buffer(self, sizehint):
+        if self._receive_buffer is not None:
+            return self._receive_buffer.get_buffer(sizehint)
+        return self._buffer
+
+    def buffer_updated(self, nbytes):
+        if self._receive_buffer is not None:
+            if self._metrics is not None:
+                self._metrics.inc('bytes_in', nbytes, side=self._side)
+            self._receive_buffer.buffer_updated(nbytes)
+            self._dispatch_buffered()
+        else:
+            self.on_read(self._buffer[:nbytes])
+
+    def _dispatch_buffered(self):
+        if self._receive_buffer is None:
+            tcp.BaseSocket._dispatch_buffered(self)
+            return
+
+        for message in self._receive_buffer.messages():
+            self.on_message(message)
+            if self._paused:
+                break
+
+    def data_received(self, data):
+        self.on_read(data)
+
+    def eof_received(self):
+        return False
+
+    def on_close(self):
+        pass
+
+
+class ClientSocket(BaseSocket):
+    _side = 'client'
+
+    def __init__(self, transport, encodings):
+        BaseSocket.__init__(self, transport._session._loop._loop, encodings, transport._session._serializers,
+                            **transport._receive_options)
+        self._transport = transport
+        self._metrics = transport._session._metrics
+
+    def connection_made(self, transport):
+        BaseSocket.connection_made(self, transport)
+        self._transport.on_connect(self)
+
+    def on_close(self):
+        self._transport.on_close(self)
+
+    def on_response(self, msgid, error, result):
+        self._transport._session.on_response(msgid, error, result)
+
+    def on_stream(self, msgid, error, chunk):
+        self._transport._session.on_stream(msgid, error, chunk)
+
+    def on_handshake(self, options):
+        self._transport.on_handshake(self, options)
+
+
+class ClientTransport(tcp.ClientTransport):
+    def __init__(self, session, address, reconnect_limit, encodings=('utf-8', None),
+                 zero_copy=False, bin_view_threshold=None):
+        tcp.ClientTransport.__init__(self, session, address, reconnect_limit, encodings)
+        self._receive_options = {'zero_copy': zero_copy, 'bin_view_threshold': bin_view_threshold}
+
+    def connect(self):
+        loop = self._session._loop._loop
+        factory = lambda: ClientSocket(self, self._encodings)
+        if isinstance(self._address, UnixAddress):
+            task = loop.create_task(loop.create_unix_connection(factory, self._address.unpack()))
+        else:
+            host, port = self._address.unpack()
+            task = loop.create_task(loop.create_connection(factory, host, port))
+        task.add_done_callback(self._on_connect_done)
+
+    def _on_connect_done(self, task):
+        if task.cancelled() or task.exception() is not None:
+            self.on_connect_failed(None)
+
+    def on_close(self, sock):
+        # Avoid calling self.on_connect_failed after self.close called.
+        if self._closed:
+            return
+
+        if sock in self._sockets:
+            self._sockets.remove(sock)
+
+
+class ServerSocket(BaseSocket):
+    _side = 'server'
+
+    def __init__(self, transport, encodings):
+        BaseSocket.__init__(self, transport._server._loop._loop, encodings, transport._server._serializers,
+                            **transport._receive_options)
+        self._transport = transport
+        self._metrics = transport._server._metrics
+
+    def connection_made(self, transport):
+        BaseSocket.connection_made(self, transport)
+        limits = self._transport._server._limits
+        if limits is not None and limits.write_buffer is not None:
+            transport.set_write_buffer_limits(high=limits.write_buffer)
+
+    def pause_reading(self):
+        self._paused = True
+        self._stream.pause_reading()
+
+    def resume_reading(self):
+        if self._paused:
+            self._paused = False
+            # Not from within the dispatch of the buffered messages
+            self._loop.call_soon(self._continue_reading)
+
+    def _continue_reading(self):
+        if self._paused or self._stream.is_closing():
+            return
+        self._dispatch_buffered()
+        if not self._paused:
+            self._stream.resume_reading()
+
+    def closed(self):
+        return self._stream is None or self._stream.is_closing()
+
+    def on_close(self):
+        self._transport._server.on_close(self)
+
+    def on_request(self, msgid, method, param, timeout=None):
+        self._transport._server.on_request(self, msgid, method, param, timeout)
+
+    def on_notify(self, method, param):
+        self._transport._server.on_notify(method, param)
+
+    def on_credit(self, msgid, credit):
+        self._transport._server.on_credit(self, msgid, credit)
+
+    def on_handshake(self, options):
+        self._transport._server.on_handshake(self, options)
+
+
+class ServerTransport(object):
+    def __init__(self, address, encodings=('utf-8', None), zero_copy=False, bin_view_threshold=None):
+        self._address = address
+        self._encodings = encodings
+        self._receive_options = {'zero_copy': zero_copy, 'bin_view_threshold': bin_view_threshold}
+        self._aio_server = None
+
+    def listen(self, server, backlog=128):
+        # Bind synchronously so that errors surface from Server.listen
+        if isinstance(self._address, UnixAddress):
+            sock = self._address.bind_sockets(backlog)[0]
+        else:
+            sock = self._address.socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(self._address.unpack())
+            sock.listen(backlog)
+
+        self._socket = sock
+        self.reopen(server)
+        self._owner = True
+
+    def reopen(self, server):
+        """\
+        Serves the already bound socket on the loop of server, e.g. in a forked worker.
+        """
+
+        self._server = server
+        self._aio_server = None
+        self._owner = False
+        loop = server._loop._loop
+        factory = lambda: ServerSocket(self, self._encodings)
+        if isinstance(self._address, UnixAddress):
+            self._task = loop.create_task(loop.create_unix_server(factory, sock=self._socket))
+        else:
+            self._task = loop.create_task(loop.create_server(factory, sock=self._socket))
+        self._task.add_done_callback(self._on_listen_done)
+
+    def _on_listen_done(self, task):
+        if not task.cancelled() and task.exception() is None:
+            self._aio_server = task.result()
+
+    def close(self):
+        if self._aio_server is not None:
+            self._aio_server.close()
+        else:
+            self._task.cancel()
+            self._socket.close()
+        if self._owner and isinstance(self._address, UnixAddress):
+            self._owner = False
+            self._address.unlink()
@@ -0,0 +1,78 @@
+"""\
+In-process transport over socket pairs, for tests.
+
+Pass this module as the builder of both Client and Server in one process.
+Servers are registered by their address instead of binding a port, and
+each connection is a socket.socketpair(), so no port or file is used.
+Any Address (or other hashable) serves as the address.
+"""
+
+import socket
+
+from tornado.iostream import IOStream
+from tornado.platform.auto import set_close_exec
+
+from msgpackrpc.error import TransportError
+from msgpackrpc.transport import tcp
+
+
+_listeners = {}
+
+
+def _key(address):
+    return address.unpack() if hasattr(address, 'unpack') else address
+
+
+def _socketpair():
+    pair = socket.socketpair()
+    for sock in pair:
+        set_close_exec(sock.fileno())
+        sock.setblocking(0)
+    return pair
+
+
+class ClientTransport(tcp.ClientTransport):
+    def connect(self):
+        loop = self._session._loop
+        listener = _listeners.get(_key(self._address))
+        if listener is None:
+            loop.add_callback(lambda: self.on_connect_failed(None))
+            return
+
+        client, server = _socketpair()
+        listener.accept(server)
+        sock = tcp.ClientSocket(IOStream(client, io_loop=loop._ioloop), self, self._encodings)
+        # After send_message queued the message which triggered the connection
+        loop.add_callback(sock.on_connect)
+
+
+class ServerTransport(object):
+    def __init__(self, address, encodings=('utf-8', None)):
+        self._address = address
+        self._encodings = encodings
+        self._server = None
+
+    def listen(self, server):
+        key = _key(self._address)
+        if key in _listeners:
+            raise TransportError("Address already in use: {0}".format(key))
+        self._server = server
+        _listeners[key] = self
+
+    def accept(self, sock):
+        """\
+        Serves the server end of a socket pair.  Safe to call from other threads.
+        """
+
+        self._server._loop.add_callback(lambda: self._on_accept(sock))
+
+    def _on_accept(self, sock):
+        tcp.ServerSocket(IOStream(sock, io_loop=self._server._loop._ioloop), self, self._encodings)
+
+    def close(self):
+        key = _key(self._address)
+        if _listeners.get(key) is self:
+            del _listeners[key]
+
+    def on_close(self, sock):
+        self._server.on_close(sock)
@@ -0,0 +1,227 @@
+"""\
+Client transport which spreads the requests over a pool of connections.
+
+Pass Builder(...) as the builder of Client.  The address of the Client may be
+a single Address or a list of Addresses of replicas; the pool keeps `size`
+connections to each of them.  A connection which fails or closes is evicted,
+its in-flight requests fail with TransportError, and it is reconnected after
+`reconnect_interval` seconds.
+"""
+
+import msgpackrpc.message
+from msgpackrpc.error import TransportError
+from msgpackrpc.transport import tcp
+
+
+ROUND_ROBIN = 'round_robin'
+LEAST_OUTSTANDING = 'least_outstanding'
+
+
+class Builder(object):
+    """\
+    Builder of pooled client transports over the transport of `base`.
+    """
+
+    def __init__(self, size=4, balancer=ROUND_ROBIN, base=tcp, reconnect_interval=1.0):
+        if balancer not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError("Unknown balancer: {0}".format(balancer))
+
+        self._size = size
+        self._balancer = balancer
+        self._reconnect_interval = reconnect_interval
+        self._member_class = _member_class(base)
+        self.ServerTransport = base.ServerTransport
+        if hasattr(base, 'Loop'):
+            self.Loop = base.Loop
+
+    def ClientTransport(self, session, address, reconnect_limit, encodings=('utf-8', None)):
+        return ClientTransport(session, address, reconnect_limit, encodings, self._size,
+                               self._balancer, self._reconnect_interval, self._member_class)
+
+
+def _member_class(base):
+    class MemberTransport(base.ClientTransport):
+        """\
+        Transport of one connection, which reports to its _Member.
+        """
+
+        def open(self):
+            if len(self._sockets) == 0 and self._connecting == 0:
+                self.connect()
+                self._connecting = 1
+
+        def on_connect(self, sock):
+            base.ClientTransport.on_connect(self, sock)
+            self._session.on_connect()
+
+        def on_close(self, sock):
+            connected = sock in self._sockets
+            base.ClientTransport.on_close(self, sock)
+            if connected and not self._closed:
+                self._session.on_connect_failed(TransportError("Connection closed"))
+
+    return MemberTransport
+
+
+class ClientTransport(object):
+    def __init__(self, session, address, reconnect_limit, encodings=('utf-8', None), size=4,
+                 balancer=ROUND_ROBIN, reconnect_interval=1.0, member_class=None):
+        self._session = session
+        self._addresses = address if isinstance(address, (list, tuple)) else [address]
+        self._reconnect_limit = reconnect_limit
+        self._encodings = encodings
+        self._balancer = balancer
+        self._reconnect_interval = reconnect_interval
+        self._member_class = member_class or _member_class(tcp)
+
+        self._members = [_Member(self, addr) for addr in self._addresses for _ in range(size)]
+        self._next = 0
+        self._pending = []
+        self._opened = False
+        self._closed = False
+
+    @property
+    def deadlines(self):
+        # Whether any connection may carry the request
+        members = [member for member in self._members if member.connected]
+        return bool(members) and all(member.transport.deadlines for member in members)
+
+    def send_message(self, message, callback=None):
+        if message[0] == msgpackrpc.message.CREDIT:
+            # Goes to the connection which carries the stream
+            for member in self._members:
+                if message[1] in member.outstanding:
+                    member.send_message(message, callback)
+            return
+
+        member = self._open()
+        if member is None:
+            self._hold([message], callback)
+        else:
+            member.send_message(message, callback)
+
+    def send_messages(self, messages, callback=None):
+        """\
+        Sends the messages over one connection, in order.
+        """
+
+        member = self._open()
+        if member is None:
+            self._hold(messages, callback)
+        else:
+            member.send_messages(messages, callback)
+
+    def _open(self):
+        if not self._opened:
+            self._opened = True
+            for member in self._members:
+                member.transport.open()
+        return self._choose()
+
+    def _hold(self, messages, callback):
+        if not self._members:
+            for message in messages[:-1]:
+                self._fail(message, None, TransportError("No connection available"))
+            self._fail(messages[-1], callback, TransportError("No connection available"))
+        else:
+            self._pending.append((messages, callback))
+
+    def _choose(self):
+        members = [member for member in self._members if member.connected]
+        if not members:
+            return None
+
+        if self._balancer == LEAST_OUTSTANDING:
+            return min(members, key=lambda member: len(member.outstanding))
+
+        self._next = (self._next + 1) % len(members)
+        return members[self._next]
+
+    def _fail(self, message, callback, reason):
+        if message[0] == msgpackrpc.message.REQUEST:
+            self._session.on_response(message[1], reason, None)
+        elif callback is not None:
+            callback()
+
+    def close(self):
+        self._closed = True
+        for member in self._members:
+            member.transport.close()
+
+        self._members = []
+        self._pending = []
+
+    def on_connect(self, member):
+        pending, self._pending = self._pending, []
+        for messages, callback in pending:
+            if len(messages) == 1:
+                self.send_message(messages[0], callback)
+            else:
+                self.send_messages(messages, callback)
+
+    def evict(self, member, reason):
+        if member not in self._members:
+            return
+
+        self._members.remove(member)
+        member.transport.close()
+        for msgid in list(member.outstanding):
+            self._session.on_response(msgid, reason, None)
+        member.outstanding.clear()
+
+        if not self._members:
+            pending, self._pending = self._pending, []
+            for messages, callback in pending:
+                for message in messages[:-1]:
+                    self._fail(message, None, reason)
+                self._fail(messages[-1], callback, reason)
+
+        address = member.address
+        def revive():
+            if not self._closed:
+                revived = _Member(self, address)
+                self._members.append(revived)
+                revived.transport.open()
+        self._session._loop.add_timeout(self._reconnect_interval, revive)
+
+
+class _Member(object):
+    """\
+    One connection of the pool. Acts as the session of its transport.
+    """
+
+    def __init__(self, pool, address):
+        self._pool = pool
+        self._loop = pool._session._loop
+        self.address = address
+        self.outstanding = set()
+        self.transport = pool._member_class(self, address, pool._reconnect_limit, encodings=pool._encodings)
+
+    def __getattr__(self, name):
+        # Options of the client are looked up on the real session
+        return getattr(self._pool._session, name)
+
+    @property
+    def connected(self):
+        return len(self.transport._sockets) != 0
+
+    def send_message(self, message, callback=None):
+        if message[0] == msgpackrpc.message.REQUEST:
+            self.outstanding.add(message[1])
+        self.transport.send_message(message, callback)
+
+    def send_messages(self, messages, callback=None):
+        for message in messages:
+            if message[0] == msgpackrpc.message.REQUEST:
+                self.outstanding.add(message[1])
+        self.transport.send_messages(messages, callback)
+
+    def on_connect(self):
+        self._pool.on_connect(self)
+
+    def on_response(self, msgid, error, result):
+        self.outstanding.discard(msgid)
+        self._pool._session.on_response(msgid, error, result)
+
+    def on_connect_failed(self, reason):
+        self._pool.evict(self, reason)
@@ -0,0 +1,207 @@
+"""\
+Transport layer which passes large payloads through shared memory, for RPC
+between processes on the same host.
+
+Messages travel over a Unix domain socket as with the unix transport (pass a
+UnixAddress or a path), but bin arguments and results of THRESHOLD bytes or
+more are written to a segment of shared memory (a file in SHM_DIR) and only
+its name is sent, as a MessagePack extension type.  The receiver maps the
+segment and gets a memoryview of it, so the payload is copied once, by the
+sender.  A Buffer is filled in place and passed without any copy.
+
+The receiver removes a segment as soon as it maps it; the memory is released
+once the memoryview is gone.  Segments of messages which were never written
+to the socket are removed when it closes.
+"""
+
+import errno
+import mmap
+import os
+import tempfile
+
+import msgpack
+
+import msgpackrpc.message
+from msgpackrpc.compat import iteritems
+from msgpackrpc.transport import tcp, unix
+
+
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+PREFIX = 'msgpackrpc-'
+THRESHOLD = 64 * 1024
+
+_BINARY = (bytes, bytearray, memoryview)
+
+
+class Buffer(object):
+    """\
+    A block of shared memory which is passed by reference.
+
+    Fill buffer.view and pass the Buffer as an argument or a result.  The
+    receiver gets a memoryview of the same memory, so do not modify it after
+    sending.
+    """
+
+    def __init__(self, size, directory=None):
+        fd, path = tempfile.mkstemp(prefix=PREFIX, dir=directory or SHM_DIR)
+        try:
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        except:
+            os.unlink(path)
+            raise
+        finally:
+            os.close(fd)
+        self.name = os.path.basename(path)
+        self.view = memoryview(self._mmap)
+
+    def __len__(self):
+        return len(self.view)
+
+    @classmethod
+    def copy(cls, data, directory=None):
+        buf = cls(len(data), directory)
+        buf.view[:] = data
+        return buf
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _ext_hook(directory, fallback):
+    def hook(code, data):
+        if code != msgpackrpc.message.EXT_SHM:
+            return fallback(code, data)
+
+        name = bytes(data).decode('ascii')
+        # Never touch anything else than a segment
+        if not name.startswith(PREFIX) or os.path.basename(name) != name:
+            raise ValueError("Invalid shared memory segment: {0}".format(name))
+        path = os.path.join(directory, name)
+        fd = os.open(path, os.O_RDWR)
+        try:
+            segment = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+            _unlink(path)
+        return memoryview(segment)
+    return hook
+
+
+class _SharedMemorySocket(object):
+    """\
+    Mixin which moves large bin fields of outgoing messages to shared memory.
+    """
+
+    _threshold = THRESHOLD
+    _directory = SHM_DIR
+
+    def _setup(self, transport):
+        self._threshold = transport._threshold
+        self._directory = transport._directory
+        # Segments of the current batch, and of the batches being written
+        self._segments = []
+        self._unsent = set()
+
+    def _new_unpacker(self):
+        return msgpack.Unpacker(encoding=self._encodings[1], ext_hook=_ext_hook(self._directory, self._serializers.ext_hook))
+
+    def send_message(self, message, callback=None):
+        tcp.BaseSocket.send_message(self, self._externalize(message), callback)
+
+    def send_messages(self, messages, callback=None):
+        tcp.BaseSocket.send_messages(self, [self._externalize(m) for m in messages], callback)
+
+    def flush(self):
+        if self._segments:
+            segments, self._segments = self._segments, []
+            self._unsent.update(segments)
+            self._batch_callbacks.append(lambda: self._unsent.difference_update(segments))
+        tcp.BaseSocket.flush(self)
+
+    def _externalize(self, obj):
+        if isinstance(obj, Buffer):
+            return self._reference(obj)
+        if isinstance(obj, _BINARY):
+            if len(obj) < self._threshold:
+                return obj
+            return self._reference(Buffer.copy(obj, self._directory))
+        if isinstance(obj, (list, tuple)):
+            return [self._externalize(item) for item in obj]
+        if isinstance(obj, dict):
+            return dict((key, self._externalize(value)) for key, value in iteritems(obj))
+        return obj
+
+    def _reference(self, buf):
+        self._segments.append(buf.name)
+        return msgpack.ExtType(msgpackrpc.message.EXT_SHM, buf.name.encode('ascii'))
+
+    def _remove_unsent(self):
+        for name in list(self._unsent) + self._segments:
+            _unlink(os.path.join(self._directory, name))
+        self._unsent = set()
+        self._segments = []
+
+
+class ClientSocket(_SharedMemorySocket, tcp.ClientSocket):
+    def __init__(self, stream, transport, encodings):
+        self._setup(transport)
+        tcp.ClientSocket.__init__(self, stream, transport, encodings)
+
+    def on_close(self):
+        self._remove_unsent()
+        tcp.ClientSocket.on_close(self)
+
+
+class ServerSocket(_SharedMemorySocket, tcp.ServerSocket):
+    def __init__(self, stream, transport, encodings):
+        self._setup(transport)
+        tcp.ServerSocket.__init__(self, stream, transport, encodings)
+
+    def on_close(self):
+        self._remove_unsent()
+        tcp.ServerSocket.on_close(self)
+
+
+class ClientTransport(unix.ClientTransport):
+    Socket = ClientSocket
+
+    def __init__(self, session, address, reconnect_limit, encodings=('utf-8', None),
+                 threshold=THRESHOLD, directory=SHM_DIR):
+        unix.ClientTransport.__init__(self, session, address, reconnect_limit, encodings)
+        self._threshold = threshold
+        self._directory = directory
+
+
+class ServerTransport(unix.ServerTransport):
+    Socket = ServerSocket
+
+    def __init__(self, address, encodings=('utf-8', None), threshold=THRESHOLD, directory=SHM_DIR):
+        unix.ServerTransport.__init__(self, address, encodings)
+        self._threshold = threshold
+        self._directory = directory
+
+
+class Builder(object):
+    """\
+    Builder of shared memory transports with other options.
+    """
+
+    def __init__(self, threshold=THRESHOLD, directory=SHM_DIR):
+        """\
+        :param threshold: bin fields of this many bytes or more go through shared memory.
+        :param directory: where the segments are created; both sides must see it.
+        """
+
+        self._options = {'threshold': threshold, 'directory': directory}
+
+    def ClientTransport(self, session, address, reconnect_limit, encodings=('utf-8', None)):
+        return ClientTransport(session, address, reconnect_limit, encodings, **self._options)
+
+    def ServerTransport(self, address, encodings=('utf-8', None)):
+        return ServerTransport(address, encodings, **self._options)
@@ -1,44 +1,256 @@
+import inspect
+import time
+
 import msgpack
 from tornado import netutil
 from tornado.iostream import IOStream
 
 import msgpackrpc.message
+from msgpackrpc import compression
+from msgpackrpc import serializer
+from msgpackrpc.compat import force_str, iteritems
 from msgpackrpc.error import RPCError, TransportError
 
 
+def _supports_partial_reads():
+    try:
+        return 'partial' in inspect.signature(IOStream.read_bytes).parameters
+    except AttributeError:
+        # Python 2
+        return 'partial' in inspect.getargspec(IOStream.read_bytes).args
+
+# Tornado < 4 cannot read whatever is available, so reading cannot be paused
+_PARTIAL_READS = _supports_partial_reads()
+
+# The method of a handshake, whether or not it is decoded
+_HANDSHAKE = frozenset([msgpackrpc.message.HANDSHAKE, msgpackrpc.message.HANDSHAKE.encode('ascii')])
+
+
+def _decode_options(param):
+    options = param[0] if param and isinstance(param[0], dict) else {}
+    return dict((force_str(key), force_str(value) if isinstance(value, bytes) else value)
+                for key, value in iteritems(options))
+
+
 class BaseSocket(object):
-    def __init__(self, stream, encodings):
+    """\
+    Messages sent during one loop iteration are packed into one batch and
+    written to the stream at once, on the next iteration.
+
+    Once a codec is negotiated by the handshake, batches of compress_threshold
+    bytes or more are sent as one compressed frame, an extension type which
+    holds the packed messages.
+
+    A request may carry a fifth element, the seconds the client still waits
+    for its response, once the server accepted deadlines in the handshake.
+    """
+
+    # Flush as soon as a batch reaches this many bytes
+    MAX_BATCH_SIZE = 256 * 1024
+    # Seconds a batch may wait for more messages; 0 flushes on the next iteration
+    MAX_BATCH_DELAY = 0
+
+    # msgpackrpc.metrics.Metrics of the session or server, and the side label
+    _metrics = None
+    _side = None
+
+    # Requests received and not responded yet, counted by the server
+    _in_flight = 0
+
+    # compression.Codec negotiated by the handshake
+    _codec = None
+    _compress_threshold = None
+
+    def __init__(self, stream, encodings, serializers=serializer.REGISTRY):
         self._stream = stream
-        self._packer = msgpack.Packer(encoding=encodings[0], default=lambda x: x.to_msgpack())
-        self._unpacker = msgpack.Unpacker(encoding=encodings[1])
+        self._encodings = encodings
+        self._serializers = serializers
+        self._packer = msgpack.Packer(encoding=encodings[0], default=serializers.default)
+        self._unpacker = self._new_unpacker()
+        self._batch = []
+        self._batch_size = 0
+        self._batch_callbacks = []
+        self._flush_scheduled = False
+        self._write_callbacks = []
+        self._unflushed = 0
+        self._paused = False
+
+    def _new_unpacker(self):
+        return msgpack.Unpacker(encoding=self._encodings[1], ext_hook=self._serializers.ext_hook)
 
     def close(self):
+        self.flush()
         self._stream.close()
 
+    def handshake(self, options):
+        """\
+        Sends the options of this side of the connection.
+        """
+
+        self.send_message([msgpackrpc.message.NOTIFY, msgpackrpc.message.HANDSHAKE, [options]])
+
+    def set_codec(self, name, threshold):
+        self._codec = compression.get(name) if name else None
+        self._compress_threshold = threshold
+
     def send_message(self, message, callback=None):
-        self._stream.write(self._packer.pack(message), callback=callback)
+        data = self._packer.pack(message)
+        self._batch.append(data)
+        self._batch_size += len(data)
+        if callback is not None:
+            self._batch_callbacks.append(callback)
+        if self._metrics is not None:
+            self._metrics.add_gauge('pending_write_bytes', len(data), side=self._side)
+
+        if self._batch_size >= self.MAX_BATCH_SIZE:
+            self.flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._schedule_flush(self.MAX_BATCH_DELAY)
+
+    def send_messages(self, messages, callback=None):
+        """\
+        Sends the messages in one write, without waiting for the loop iteration.
+        """
+
+        for message in messages:
+            data = self._packer.pack(message)
+            self._batch.append(data)
+            self._batch_size += len(data)
+            if self._metrics is not None:
+                self._metrics.add_gauge('pending_write_bytes', len(data), side=self._side)
+        if callback is not None:
+            self._batch_callbacks.append(callback)
+        self.flush()
+
+    def flush(self):
+        self._flush_scheduled = False
+        if not self._batch:
+            return
+
+        data = b''.join(self._batch) if len(self._batch) > 1 else self._batch[0]
+        if self._codec is not None and len(data) >= self._compress_threshold:
+            data = self._compress(data)
+        callbacks = self._batch_callbacks
+        if self._metrics is not None:
+            self._metrics.add_gauge('pending_write_bytes', -self._batch_size, side=self._side)
+            self._metrics.inc('bytes_out', len(data), side=self._side)
+        self._batch = []
+        self._batch_size = 0
+        self._batch_callbacks = []
+        self._write(data, callbacks)
+
+    def _compress(self, data):
+        start = time.time()
+        frame = self._packer.pack(msgpack.ExtType(msgpackrpc.message.EXT_COMPRESSED, self._codec.compress(data)))
+        if len(frame) >= len(data):
+            return data
+
+        if self._metrics is not None:
+            codec = self._codec.name
+            self._metrics.observe('compress_seconds', time.time() - start, side=self._side, codec=codec)
+            self._metrics.inc('compress_bytes_in', len(data), side=self._side, codec=codec)
+            self._metrics.inc('compress_bytes_out', len(frame), side=self._side, codec=codec)
+        return frame
+
+    def _decompress(self, frame):
+        if frame.code != msgpackrpc.message.EXT_COMPRESSED or self._codec is None:
+            raise RPCError("Unexpected extension frame: code = {0}".format(frame.code))
+
+        start = time.time()
+        data = self._codec.decompress(frame.data)
+        if self._metrics is not None:
+            self._metrics.observe('decompress_seconds', time.time() - start, side=self._side, codec=self._codec.name)
+        return data
+
+    def _schedule_flush(self, delay):
+        io_loop = self._stream.io_loop
+        if delay:
+            io_loop.add_timeout(time.time() + delay, self.flush)
+        else:
+            io_loop.add_callback(self.flush)
+
+    def _write(self, data, callbacks):
+        if self._stream.closed():
+            return
+
+        # The stream keeps only the latest write callback, which fires once
+        # everything written so far is flushed.
+        self._write_callbacks.extend(callbacks)
+        self._unflushed += len(data)
+        self._stream.write(data, callback=self._on_written)
+
+    def _on_written(self):
+        self._unflushed = 0
+        callbacks, self._write_callbacks = self._write_callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def write_buffer_size(self):
+        """\
+        Bytes written to the stream and not sent yet.
+        """
+
+        return self._unflushed
+
+    def on_drained(self, callback):
+        """\
+        Calls callback once the stream sent everything written so far.
+        """
+
+        if self._unflushed == 0:
+            self._stream.io_loop.add_callback(callback)
+        else:
+            self._write_callbacks.append(callback)
 
     def on_read(self, data):
+        if self._metrics is not None:
+            self._metrics.inc('bytes_in', len(data), side=self._side)
         self._unpacker.feed(data)
-        for message in self._unpacker:
+        self._dispatch_buffered()
+
+    def _dispatch_buffered(self):
+        # Stops as soon as the messages pause reading; the rest stays buffered
+        while not self._paused:
+            try:
+                message = next(self._unpacker)
+            except StopIteration:
+                return
             self.on_message(message)
 
     def on_message(self, message, *args):
+        if isinstance(message, msgpack.ExtType):
+            unpacker = self._new_unpacker()
+            unpacker.feed(self._decompress(message))
+            for packed in unpacker:
+                self.on_message(packed)
+            return
+
         msgsize = len(message)
-        if msgsize != 4 and msgsize != 3:
+        if msgsize != 4 and msgsize != 3 and msgsize != 5:
             raise RPCError("Invalid MessagePack-RPC protocol: message = {0}".format(message))
 
         msgtype = message[0]
         if msgtype == msgpackrpc.message.REQUEST:
-            self.on_request(message[1], message[2], message[3])
+            if msgsize == 5:
+                self.on_request(message[1], message[2], message[3], message[4])
+            else:
+                self.on_request(message[1], message[2], message[3])
         elif msgtype == msgpackrpc.message.RESPONSE:
             self.on_response(message[1], message[2], message[3])
         elif msgtype == msgpackrpc.message.NOTIFY:
-            self.on_notify(message[1], message[2])
+            if message[1] in _HANDSHAKE:
+                self.on_handshake(_decode_options(message[2]))
+            else:
+                self.on_notify(message[1], message[2])
+        elif msgtype == msgpackrpc.message.STREAM:
+            self.on_stream(message[1], message[2], message[3])
+        elif msgtype == msgpackrpc.message.CREDIT:
+            self.on_credit(message[1], message[2])
         else:
             raise RPCError("Unknown message type: type = {0}".format(msgtype))
 
-    def on_request(self, msgid, method, param):
+    def on_request(self, msgid, method, param, timeout=None):
         raise NotImplementedError("on_request not implemented");
 
     def on_response(self, msgid, error, result):
@@ -47,11 +259,23 @@ class BaseSocket(object):
     def on_notify(self, method, param):
         raise NotImplementedError("on_notify not implemented");
 
+    def on_stream(self, msgid, error, chunk):
+        raise NotImplementedError("on_stream not implemented");
+
+    def on_credit(self, msgid, credit):
+        raise NotImplementedError("on_credit not implemented");
+
+    def on_handshake(self, options):
+        raise NotImplementedError("on_handshake not implemented");
+
 
 class ClientSocket(BaseSocket):
+    _side = 'client'
+
     def __init__(self, stream, transport, encodings):
-        BaseSocket.__init__(self, stream, encodings)
+        BaseSocket.__init__(self, stream, encodings, transport._session._serializers)
         self._transport = transport
+        self._metrics = transport._session._metrics
         self._stream.set_close_callback(self.on_close)
 
     def connect(self):
@@ -70,8 +294,19 @@ class ClientSocket(BaseSocket):
     def on_response(self, msgid, error, result):
         self._transport._session.on_response(msgid, error, result)
 
+    def on_stream(self, msgid, error, chunk):
+        self._transport._session.on_stream(msgid, error, chunk)
+
+    def on_handshake(self, options):
+        self._transport.on_handshake(self, options)
+
 
 class ClientTransport(object):
+    Socket = ClientSocket
+
+    # Whether the server accepted deadlines in the handshake
+    deadlines = False
+
     def __init__(self, session, address, reconnect_limit, encodings=('utf-8', None)):
         self._session = session
         self._address = address
@@ -93,9 +328,18 @@ class ClientTransport(object):
             sock = self._sockets[0]
             sock.send_message(message, callback)
 
+    def send_messages(self, messages, callback=None):
+        if len(self._sockets) == 0:
+            for message in messages[:-1]:
+                self.send_message(message)
+            self.send_message(messages[-1], callback)
+        else:
+            sock = self._sockets[0]
+            sock.send_messages(messages, callback)
+
     def connect(self):
         stream = IOStream(self._address.socket(), io_loop=self._session._loop._ioloop)
-        socket = ClientSocket(stream, self, self._encodings)
+        socket = self.Socket(stream, self, self._encodings)
         socket.connect();
 
     def close(self):
@@ -109,10 +353,16 @@ class ClientTransport(object):
 
     def on_connect(self, sock):
         self._sockets.append(sock)
+        self.deadlines = False
+        sock.handshake({'compression': self._session._compression, 'deadlines': True})
         for pending, callback in self._pending:
             sock.send_message(pending, callback)
         self._pending = []
 
+    def on_handshake(self, sock, options):
+        sock.set_codec(options.get('compression'), self._session._compress_threshold)
+        self.deadlines = bool(options.get('deadlines'))
+
     def on_connect_failed(self, sock):
         if self._connecting < self._reconnect_limit:
             self.connect()
@@ -135,20 +385,71 @@ class ClientTransport(object):
 
 
 class ServerSocket(BaseSocket):
+    """\
+    Reads in chunks, so that the server can stop reading while it is overloaded.
+    """
+
+    _side = 'server'
+
+    READ_CHUNK_SIZE = 64 * 1024
+
     def __init__(self, stream, transport, encodings):
-        BaseSocket.__init__(self, stream, encodings)
+        BaseSocket.__init__(self, stream, encodings, transport._server._serializers)
         self._transport = transport
-        self._stream.read_until_close(self.on_read, self.on_read)
+        self._metrics = transport._server._metrics
+        self._read_pending = False
+        self._stream.set_close_callback(self.on_close)
+        if _PARTIAL_READS:
+            self._read()
+        else:
+            self._stream.read_until_close(self.on_read, self.on_read)
+
+    def _read(self):
+        if self._stream.closed():
+            return
+        self._read_pending = True
+        self._stream.read_bytes(self.READ_CHUNK_SIZE, self._on_chunk, partial=True)
+
+    def _on_chunk(self, data):
+        self._read_pending = False
+        self.on_read(data)
+        if not self._paused:
+            self._read()
+
+    def pause_reading(self):
+        self._paused = True
+
+    def resume_reading(self):
+        if self._paused:
+            self._paused = False
+            # Not from within the dispatch of the buffered messages
+            self._stream.io_loop.add_callback(self._continue_reading)
+
+    def _continue_reading(self):
+        if self._paused or self._stream.closed():
+            return
+        self._dispatch_buffered()
+        if not self._paused and not self._read_pending and _PARTIAL_READS:
+            self._read()
+
+    def closed(self):
+        return self._stream.closed()
 
     def on_close(self):
         self._transport.on_close(self)
 
-    def on_request(self, msgid, method, param):
-        self._transport._server.on_request(self, msgid, method, param)
+    def on_request(self, msgid, method, param, timeout=None):
+        self._transport._server.on_request(self, msgid, method, param, timeout)
 
     def on_notify(self, method, param):
         self._transport._server.on_notify(method, param)
 
+    def on_credit(self, msgid, credit):
+        self._transport._server.on_credit(self, msgid, credit)
+
+    def on_handshake(self, options):
+        self._transport._server.on_handshake(self, options)
+
 
 class MessagePackServer(netutil.TCPServer):
     def __init__(self, transport, io_loop=None, encodings=None):
@@ -157,18 +458,31 @@ class MessagePackServer(netutil.TCPServer):
         netutil.TCPServer.__init__(self, io_loop=io_loop)
 
     def handle_stream(self, stream, address):
-        ServerSocket(stream, self._transport, self._encodings)
+        self._transport.Socket(stream, self._transport, self._encodings)
 
 
 class ServerTransport(object):
+    Socket = ServerSocket
+
     def __init__(self, address, encodings=('utf-8', None)):
         self._address = address;
         self._encodings = encodings
 
     def listen(self, server):
+        self._sockets = self._address.bind_sockets()
+        self.reopen(server)
+
+    def reopen(self, server):
+        """\
+        Serves the already bound sockets on the loop of server, e.g. in a forked worker.
+        """
+
         self._server = server;
         self._mp_server = MessagePackServer(self, io_loop=self._server._loop._ioloop, encodings=self._encodings)
-        self._mp_server.listen(self._address.port)
+        self._mp_server.add_sockets(self._sockets)
 
     def close(self):
         self._mp_server.stop()
+
+    def on_close(self, sock):
+        self._server.on_close(sock)
@@ -0,0 +1,42 @@
+"""\
+Transport layer over Unix domain sockets, for RPC on the same host.
+
+Pass this module as the builder of Client or Server, with a UnixAddress or a
+path as the address.  Paths which start with '@' are in the abstract
+namespace of Linux.  The socket file of a Server is removed when it closes.
+"""
+
+from msgpackrpc.address import UnixAddress
+from msgpackrpc.transport import tcp
+
+
+def _unix_address(address):
+    if isinstance(address, UnixAddress):
+        return address
+    return UnixAddress(address)
+
+
+class ClientTransport(tcp.ClientTransport):
+    def __init__(self, session, address, reconnect_limit, encodings=('utf-8', None)):
+        tcp.ClientTransport.__init__(self, session, _unix_address(address), reconnect_limit, encodings)
+
+
+class ServerTransport(tcp.ServerTransport):
+    def __init__(self, address, encodings=('utf-8', None)):
+        tcp.ServerTransport.__init__(self, _unix_address(address), encodings)
+        self._owner = False
+
+    def listen(self, server):
+        tcp.ServerTransport.listen(self, server)
+        self._owner = True
+
+    def reopen(self, server):
+        # Forked workers share the file with the process which bound it
+        self._owner = False
+        tcp.ServerTransport.reopen(self, server)
+
+    def close(self):
+        tcp.ServerTransport.close(self)
+        if self._owner:
+            self._owner = False
+            self._address.unlink()
@@ -1,17 +1,62 @@
-from time import sleep
+from time import sleep, time
+import datetime
+import decimal
+import os
+import signal
 import threading
 try:
     import unittest2 as unittest
 except ImportError:
     import unittest
 
+import msgpack
+
 import helper
 import msgpackrpc
+from msgpackrpc import bench
 from msgpackrpc import error
+from msgpackrpc import serializer
+from msgpackrpc.cache import ResultCache
+from msgpackrpc.framing import ReceiveBuffer, frame_size
+from msgpackrpc.metrics import Histogram, Metrics
+from msgpackrpc.transport import memory
+from msgpackrpc.transport import pool
+from msgpackrpc.transport import shm
+from msgpackrpc.transport import tcp
+from msgpackrpc.transport import unix
+from msgpackrpc.timer import TimerWheel
+
+try:
+    # Python 3.6+
+    exec('''
+import asyncio
+
+async def acount_up(n):
+    for i in range(n):
+        await asyncio.sleep(0)
+        yield i
+
+async def consume(stream):
+    return [chunk async for chunk in stream]
+
+def async_sleep(loop, cancelled):
+    async def sleep(seconds, value):
+        future = loop.create_future()
+        loop.add_timeout(seconds, lambda: future.done() or future.set_result(value))
+        try:
+            return await future
+        except BaseException:
+            cancelled.append(value)
+            raise
+    return sleep
+''')
+except SyntaxError:
+    acount_up = consume = async_sleep = None
 
 
 class TestMessagePackRPC(unittest.TestCase):
     ENABLE_TIMEOUT_TEST = False
+    BUILDER = tcp
 
     class TestArg:
         ''' this class must know completely how to deserialize '''
@@ -54,10 +99,52 @@ class TestMessagePackRPC(unittest.TestCase):
         def raise_error(self):
             raise Exception('error')
 
+        def bin_info(self, data):
+            return [type(data).__name__, len(data)]
+
+        def zeros(self, n):
+            return b'\0' * n
+
+        def identity(self, value):
+            return value
+
+        def tick(self, key):
+            self.ticks = getattr(self, 'ticks', 0) + 1
+            return [key, self.ticks]
+
+        def pid(self):
+            return os.getpid()
+
+        def crash(self):
+            os._exit(1)
+
+        def _private(self):
+            return "secret"
+
+        def count_up(self, n):
+            for i in range(n):
+                yield i
+
+        def broken_stream(self):
+            yield 1
+            raise Exception('broken')
+
+        @msgpackrpc.server.run_in_thread_pool(limit=1)
+        def sleep_in_thread(self, seconds):
+            sleep(seconds)
+            return seconds
+
+        @msgpackrpc.server.run_in_process_pool()
+        def pid_in_process(self):
+            return os.getpid()
+
         def long_exec(self):
             sleep(3)
             return 'finish!'
 
+        def never(self):
+            return msgpackrpc.server.AsyncResult()
+
         def async_result(self):
             ar = msgpackrpc.server.AsyncResult()
             def do_async():
@@ -69,25 +156,26 @@ class TestMessagePackRPC(unittest.TestCase):
     def setUp(self):
         self._address = msgpackrpc.Address('localhost', helper.unused_port())
 
-    def setup_env(self):
+    def setup_env(self, server_metrics=None, client_metrics=None, **server_options):
         def _on_started():
             self._server._loop.dettach_periodic_callback()
-            lock.release()
+            started.set()
         def _start_server(server):
             server._loop.attach_periodic_callback(_on_started, 1)
             server.start()
             server.close()
 
-        self._server = msgpackrpc.Server(TestMessagePackRPC.TestServer())
+        self._server = msgpackrpc.Server(TestMessagePackRPC.TestServer(), builder=self.BUILDER, metrics=server_metrics,
+                                         **server_options)
         self._server.listen(self._address)
         self._thread = threading.Thread(target=_start_server, args=(self._server,))
 
-        lock = threading.Lock()
+        started = threading.Event()
         self._thread.start()
-        lock.acquire()
-        lock.acquire()   # wait for the server to start
+        started.wait()   # wait for the server to start
 
-        self._client = msgpackrpc.Client(self._address, unpack_encoding='utf-8')
+        self._client = msgpackrpc.Client(self._address, builder=self.BUILDER, unpack_encoding='utf-8',
+                                         metrics=client_metrics)
         return self._client;
 
     def tearDown(self):
@@ -135,6 +223,253 @@ class TestMessagePackRPC(unittest.TestCase):
         self.assertEqual(future2.result, 3, "'sum' result is incorrect in call_async")
         self.assertIsNone(future3.result, "'nil' result is incorrect in call_async")
 
+    def test_add_done_callback(self):
+        client = self.setup_env();
+
+        results = []
+        futures = [client.call_async('sum', i, i) for i in range(100)]
+        for future in futures:
+            future.add_done_callback(lambda f: results.append(f.result))
+        futures[-1].join()
+
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(sorted(results), [i * 2 for i in range(100)])
+
+        late = []
+        futures[0].add_done_callback(late.append)
+        self.assertEqual(late, [futures[0]])
+
+    def test_call_batch(self):
+        client = self.setup_env();
+
+        batch = client.call_batch([('sum', (i, i)) for i in range(50)])
+        self.assertEqual(batch.get(), [i * 2 for i in range(50)])
+        self.assertEqual(client.map('sum', [(1, 2), (3, 4)]), [3, 7])
+        self.assertEqual(client.call_batch([]).get(), [])
+
+        batch = client.call_batch([('hello', ()), ('raise_error', ()), ('sum', (1, 2))])
+        results = batch.get(return_exceptions=True)
+        self.assertEqual(results[0], "world")
+        self.assertTrue(isinstance(results[1], error.RPCError))
+        self.assertEqual(results[2], 3)
+        self.assertRaises(error.RPCError, batch.get)
+
+        batch = client.call_batch([('sum', (i, 1)) for i in range(10)])
+        completed = [(index, future.get()) for index, future in batch.as_completed()]
+        self.assertEqual(sorted(completed), [(i, i + 1) for i in range(10)])
+
+    def test_metrics(self):
+        server_metrics = Metrics()
+        client_metrics = Metrics()
+        client = self.setup_env(server_metrics, client_metrics);
+
+        self.assertEqual(client.map('sum', [(i, i) for i in range(10)]), [i * 2 for i in range(10)])
+        self.assertRaises(error.RPCError, lambda: client.call('raise_error'))
+        self.assertRaises(error.TimeoutError, lambda: client.call('sleep_in_thread', 0.5, timeout=0.1))
+        self.assertEqual(client.call('hello'), "world")
+        sleep(0.5)
+
+        self.assertEqual(client_metrics.counter('requests', side='client', method='sum'), 10)
+        self.assertEqual(client_metrics.counter('errors', side='client', method='raise_error'), 1)
+        self.assertEqual(client_metrics.counter('timeouts', side='client', method='sleep_in_thread'), 1)
+        self.assertEqual(client_metrics.gauge('in_flight', side='client'), 0)
+        self.assertEqual(client_metrics.gauge('pending_write_bytes', side='client'), 0)
+        self.assertTrue(client_metrics.counter('bytes_in', side='client') > 0)
+        self.assertTrue(client_metrics.counter('bytes_out', side='client') > 0)
+        self.assertEqual(client_metrics.histogram('request_seconds', side='client', method='sum').count, 10)
+
+        self.assertEqual(server_metrics.counter('requests', side='server', method='sum'), 10)
+        self.assertEqual(server_metrics.counter('errors', side='server', method='raise_error'), 1)
+        self.assertEqual(server_metrics.gauge('in_flight', side='server'), 0)
+        self.assertEqual(server_metrics.counter('bytes_in', side='server'),
+                         client_metrics.counter('bytes_out', side='client'))
+
+        snapshot = client_metrics.snapshot()
+        self.assertEqual(snapshot['histograms']['request_seconds'][0]['value']['count'] > 0, True)
+        self.assertTrue('msgpackrpc_requests_total{method="sum",side="client"} 10' in client_metrics.prometheus().splitlines())
+
+    def test_backpressure(self):
+        client = self.setup_env(max_in_flight=1, max_write_buffer=1);
+
+        done = []
+        slow = client.call_async('sleep_in_thread', 0.2)
+        slow.add_done_callback(lambda f: done.append('slow'))
+        fast = client.call_async('hello')
+        fast.add_done_callback(lambda f: done.append('fast'))
+        self.assertEqual(fast.get(), "world")
+        self.assertEqual(done, ['slow', 'fast'])
+
+        self.assertEqual(client.map('sum', [(i, i) for i in range(100)]), [i * 2 for i in range(100)])
+        self.assertEqual(self._server._limits.in_flight, 0)
+
+    def test_reject_overload(self):
+        client = self.setup_env(max_in_flight=1, reject_overload=True);
+
+        slow = client.call_async('sleep_in_thread', 0.2)
+        self.assertRaises(error.OverloadError, lambda: client.call('hello'))
+        self.assertEqual(slow.get(), 0.2)
+        self.assertEqual(client.call('hello'), "world")
+
+    def test_max_outstanding(self):
+        self.setup_env();
+
+        def limited_client(admission):
+            return msgpackrpc.Client(self._address, builder=self.BUILDER, unpack_encoding='utf-8',
+                                     max_outstanding=1, admission=admission)
+
+        client = limited_client(msgpackrpc.session.BLOCK)
+        slow = client.call_async('sleep_in_thread', 0.2)
+        fast = client.call_async('hello')
+        self.assertTrue(slow.done())
+        self.assertEqual(fast.get(), "world")
+        client.close()
+
+        client = limited_client(msgpackrpc.session.WAIT)
+        slow = client.call_async('sleep_in_thread', 0.2)
+        fast = client.call_async('hello')
+        admission = client.admission()
+        self.assertFalse(slow.done() or fast.done() or admission.done())
+        admission.join()
+        self.assertTrue(slow.done() and fast.done())
+        self.assertEqual(fast.get(), "world")
+        self.assertEqual(client.call_batch([('sum', (i, i)) for i in range(5)]).get(), [0, 2, 4, 6, 8])
+        client.close()
+
+        client = limited_client(msgpackrpc.session.FAIL)
+        slow = client.call_async('sleep_in_thread', 0.2)
+        self.assertRaises(error.OverloadError, lambda: client.call('hello'))
+        self.assertEqual(slow.get(), 0.2)
+        self.assertEqual(client.call('hello'), "world")
+        client.close()
+
+    def test_compression(self):
+        server_metrics = Metrics()
+        client_metrics = Metrics()
+        self.setup_env(server_metrics, compression=True);
+
+        client = msgpackrpc.Client(self._address, builder=self.BUILDER, unpack_encoding='utf-8',
+                                   metrics=client_metrics, compression='zlib')
+        self.assertEqual(client.call('sum', 1, 2), 3)
+        self.assertEqual(client.call('bin_info', 'x' * 100000)[1], 100000)
+        self.assertEqual(client.call('count_up', 20000), list(range(20000)))
+        client.close()
+
+        compressed = client_metrics.counter('compress_bytes_out', side='client', codec='zlib')
+        self.assertTrue(0 < compressed < client_metrics.counter('compress_bytes_in', side='client', codec='zlib'))
+        self.assertTrue(server_metrics.counter('compress_bytes_out', side='server', codec='zlib') > 0)
+        self.assertEqual(client_metrics.histogram('decompress_seconds', side='client', codec='zlib').count, 1)
+
+        # Without compression on the client
+        self.assertEqual(self._client.call('count_up', 20000), list(range(20000)))
+
+    def test_compression_refused(self):
+        self.setup_env();
+
+        metrics = Metrics()
+        client = msgpackrpc.Client(self._address, builder=self.BUILDER, unpack_encoding='utf-8',
+                                   metrics=metrics, compression=True)
+        self.assertEqual(client.call('count_up', 20000), list(range(20000)))
+        self.assertEqual(client.call('bin_info', 'x' * 100000)[1], 100000)
+        client.close()
+        self.assertEqual(metrics.counter('compress_bytes_out', side='client', codec='zlib'), 0)
+        self.assertRaises(ValueError, lambda: msgpackrpc.Client(self._address, compression='unknown'))
+
+    def test_serializers(self):
+        client = self.setup_env();
+
+        now = datetime.datetime(2020, 1, 2, 3, 4, 5, 678901)
+        utc = now.replace(tzinfo=serializer._UTC)
+        self.assertEqual(client.call('identity', [now, utc, decimal.Decimal('1.10')]), [now, utc, decimal.Decimal('1.10')])
+        self.assertEqual(client.call('identity', utc).tzinfo.utcoffset(None), datetime.timedelta(0))
+
+    def test_result_cache(self):
+        server_cache = ResultCache(['tick'], ttl=0.2)
+        self.setup_env(cache=server_cache);
+
+        client_cache = ResultCache(['tick'])
+        client = msgpackrpc.Client(self._address, builder=self.BUILDER, unpack_encoding='utf-8', cache=client_cache)
+        first = client.call('tick', 'a')
+        self.assertEqual(client.call('tick', 'a'), first)
+        self.assertEqual(client.call('sum', 1, 2), 3)
+
+        futures = [client.call_async('tick', 'b') for _ in range(3)]
+        results = [future.get() for future in futures]
+        self.assertEqual(results, [results[0]] * 3)
+        self.assertFalse(results[0] is results[1])
+
+        stats = client_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['coalesced'], stats['entries']), (1, 2, 2, 2))
+        self.assertEqual(stats['hit_rate'], 0.6)
+
+        # Served by the cache of the server
+        client_cache.invalidate('tick', 'a')
+        self.assertEqual(client.call('tick', 'a'), first)
+        self.assertEqual(server_cache.stats()['hits'], 1)
+
+        sleep(0.3)
+        client_cache.invalidate('tick')
+        self.assertEqual(len(client_cache), 0)
+        self.assertNotEqual(client.call('tick', 'a'), first)
+        client.close()
+
+    def test_thread_safe_client(self):
+        self.setup_env();
+
+        client = msgpackrpc.ThreadSafeClient(self._address, builder=self.BUILDER, unpack_encoding='utf-8')
+        results = {}
+        def worker(n):
+            futures = [client.call_async('sum', n, i) for i in range(50)]
+            results[n] = [future.result() for future in futures] + [client.call('hello')]
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, dict((n, [n + i for i in range(50)] + ["world"]) for n in range(8)))
+        self.assertRaises(error.RPCError, lambda: client.call('raise_error'))
+        client.notify('hello')
+
+        slow = client.call_async('sleep_in_thread', 1)
+        sleep(0.1)
+        client.close()
+        self.assertRaises(error.TransportError, slow.result)
+        self.assertRaises(error.TransportError, lambda: client.call('hello'))
+
+    def test_write_coalescing(self):
+        client = self.setup_env();
+        client.call('hello')
+        if not hasattr(client._transport, '_sockets'):
+            return
+
+        stream = client._transport._sockets[0]._stream
+        writes = []
+        write = stream.write
+        def counting_write(data, *args, **kwargs):
+            writes.append(data)
+            return write(data, *args, **kwargs)
+        stream.write = counting_write
+
+        futures = [client.call_async('sum', i, 1) for i in range(100)]
+        self.assertEqual([future.get() for future in futures], list(range(1, 101)))
+        self.assertEqual(len(writes), 1)
+
+    def test_thread_pool(self):
+        client = self.setup_env();
+
+        before = time()
+        future1 = client.call_async('sleep_in_thread', 0.3)
+        future2 = client.call_async('sleep_in_thread', 0.3)
+        self.assertEqual(client.call('hello'), "world")
+        self.assertTrue(time() - before < 0.3, "the loop was blocked by a thread pool method")
+
+        self.assertEqual(future1.get(), 0.3)
+        self.assertEqual(future2.get(), 0.3)
+        self.assertTrue(time() - before >= 0.6, "the limit of the method was not applied")
+
+    def test_process_pool(self):
+        client = self.setup_env();
+        self.assertNotEqual(client.call('pid_in_process'), client.call('pid'))
+
     def test_notify(self):
         client = self.setup_env();
 
@@ -162,14 +497,138 @@ class TestMessagePackRPC(unittest.TestCase):
             message = e.args[0]
             self.assertEqual(message, "'unknown' method not found", "Error message mismatched")
 
+    def test_register(self):
+        client = self.setup_env();
+
+        self._server.register(lambda x, y=1: x + y, name='add', validate_args=True)
+        @self._server.register(name='count')
+        def count_args(*args):
+            return len(args)
+
+        self.assertEqual(client.call('add', 1), 2)
+        self.assertEqual(client.call('add', 1, 2), 3)
+        self.assertEqual(client.call('count', 'a', 'b'), 2)
+        self.assertEqual(client.call('hello'), "world")
+        try:
+            client.call('add')
+            self.assertTrue(False)
+        except error.RPCError as e:
+            self.assertEqual(e.args[0], "'add' takes 1 to 2 arguments (0 given)")
+        self.assertRaises(error.RPCError, lambda: client.call('_private'))
+
+        methods = self._server.methods
+        self.assertTrue('add' in methods and 'hello' in methods and 'count' in methods)
+        self.assertFalse('_private' in methods)
+
+    def test_stream(self):
+        client = self.setup_env();
+
+        self.assertEqual(list(client.call_stream('count_up', 100, window=4)), list(range(100)))
+        self.assertEqual(client.call('count_up', 5), [0, 1, 2, 3, 4])
+
+        stream = client.call_stream('broken_stream')
+        self.assertEqual(next(stream), 1)
+        self.assertRaises(error.RPCError, lambda: next(stream))
+
+        stream = client.call_stream('count_up', 1 << 30, window=2)
+        self.assertEqual(next(stream), 0)
+        stream.close()
+        self.assertEqual(client.call('hello'), "world")
+        self.assertEqual(self._server._streams, {})
+
+        if acount_up is not None:
+            self._server.register(acount_up)
+            self.assertEqual(list(client.call_stream('acount_up', 10, window=3)), list(range(10)))
+            self.assertEqual(client.call('acount_up', 3), [0, 1, 2])
+
     def test_async_result(self):
         client = self.setup_env();
         self.assertEqual(client.call('async_result'), "You are async!")
 
+    def _setup_sleep(self, **server_options):
+        if async_sleep is None:
+            raise unittest.SkipTest("async def requires Python 3.5+")
+        client = self.setup_env(unpack_encoding='utf-8', **server_options)
+        cancelled = []
+        self._server.register(async_sleep(self._server._loop, cancelled))
+        return client, cancelled
+
+    def _wait_until(self, predicate):
+        for _ in range(200):
+            if predicate():
+                return
+            sleep(0.01)
+        self.fail("timed out waiting for the server")
+
+    def test_coroutine_handler(self):
+        client, cancelled = self._setup_sleep(handler_timeout=0.5)
+
+        # Completes out of order
+        slow = client.call_async('sleep', 0.3, 'slow')
+        fast = client.call_async('sleep', 0.01, 'fast')
+        self.assertEqual(fast.get(), 'fast')
+        self.assertFalse(slow.done())
+        self.assertEqual(slow.get(), 'slow')
+
+        self.assertRaises(error.TimeoutError, lambda: client.call('sleep', 5, 'late'))
+        self.assertEqual(cancelled, ['late'])
+        self.assertEqual(self._server._handlers, set())
+        self.assertEqual(self._server._pending, {})
+
+    def test_coroutine_handler_deadline(self):
+        client, cancelled = self._setup_sleep()
+
+        impatient = msgpackrpc.Client(self._address, timeout=0.3, builder=self.BUILDER, unpack_encoding='utf-8')
+        try:
+            self.assertEqual(impatient.call('hello'), 'world')
+            self.assertTrue(impatient._transport.deadlines)
+            self.assertRaises(error.TimeoutError, lambda: impatient.call('sleep', 5, 'abandoned'))
+            # The server gave up at the same time
+            self._wait_until(lambda: cancelled)
+            self.assertEqual(cancelled, ['abandoned'])
+        finally:
+            impatient.close()
+
+    def test_coroutine_handler_cancelled_on_close(self):
+        client, cancelled = self._setup_sleep(max_total_in_flight=3)
+
+        other = msgpackrpc.Client(self._address, builder=self.BUILDER, unpack_encoding='utf-8')
+        other.call_async('sleep', 5, 'orphan')
+        other.call_async('never')
+        self.assertEqual(other.call('hello'), 'world')
+        self.assertEqual(len(self._server._pending), 2)
+        other.close()
+        # Let the loop of the client close its socket
+        other._loop.add_timeout(0.05, other._loop.stop)
+        other._loop.start()
+
+        self._wait_until(lambda: not self._server._pending)
+        self.assertEqual(cancelled, ['orphan'])
+        self.assertEqual(self._server._handlers, set())
+        self.assertEqual(self._server._limits.in_flight, 0)
+        self.assertEqual(client.call('sleep', 0.01, 'done'), 'done')
+
+    def test_max_async_handlers(self):
+        client, cancelled = self._setup_sleep(max_async_handlers=1)
+
+        first = client.call_async('sleep', 0.2, 'first')
+        second = client.call_async('sleep', 0.01, 'second')
+        # The second waits for the first to complete
+        self.assertEqual(second.get(), 'second')
+        self.assertTrue(first.done())
+        self.assertEqual(first.get(), 'first')
+
+    def test_max_async_handlers_rejected(self):
+        client, cancelled = self._setup_sleep(max_async_handlers=1, reject_overload=True)
+
+        first = client.call_async('sleep', 0.2, 'first')
+        self.assertRaises(error.OverloadError, lambda: client.call('sleep', 0, 'second'))
+        self.assertEqual(first.get(), 'first')
+
     def test_connect_failed(self):
         client = self.setup_env();
         port = helper.unused_port()
-        client = msgpackrpc.Client(msgpackrpc.Address('localhost', port), unpack_encoding='utf-8')
+        client = msgpackrpc.Client(msgpackrpc.Address('localhost', port), builder=self.BUILDER, unpack_encoding='utf-8')
         self.assertRaises(error.TransportError, lambda: client.call('hello'))
 
     def test_timeout(self):
@@ -178,12 +637,380 @@ class TestMessagePackRPC(unittest.TestCase):
         if self.__class__.ENABLE_TIMEOUT_TEST:
             self.assertEqual(client.call('long_exec'), 'finish!', "'long_exec' result is incorrect")
 
-            client = msgpackrpc.Client(self._address, timeout=1, unpack_encoding='utf-8')
+            client = msgpackrpc.Client(self._address, timeout=1, builder=self.BUILDER, unpack_encoding='utf-8')
             self.assertRaises(error.TimeoutError, lambda: client.call('long_exec'))
+
+            client = msgpackrpc.Client(self._address, timeout=None, builder=self.BUILDER, unpack_encoding='utf-8')
+            self.assertRaises(error.TimeoutError, lambda: client.call('long_exec', timeout=0.5))
         else:
             print("Skip test_timeout")
 
 
+try:
+    from msgpackrpc.transport import asyncio as asyncio_transport
+except (ImportError, SyntaxError):
+    asyncio_transport = None
+
+
+@unittest.skipIf(asyncio_transport is None, "asyncio is not available")
+class TestAsyncioTransport(TestMessagePackRPC):
+    BUILDER = asyncio_transport
+
+    def test_await(self):
+        client = self.setup_env();
+
+        aio_loop = client._loop._loop
+        self.assertEqual(aio_loop.run_until_complete(client.call_async('sum', 1, 2)), 3)
+        self.assertRaises(error.RPCError, lambda: aio_loop.run_until_complete(client.call_async('raise_error')))
+
+    @unittest.skipIf(consume is None, "async generators are not available")
+    def test_async_stream(self):
+        client = self.setup_env();
+
+        aio_loop = client._loop._loop
+        self.assertEqual(aio_loop.run_until_complete(consume(client.call_stream('count_up', 50, window=4))),
+                         list(range(50)))
+
+
+@unittest.skipIf(asyncio_transport is None, "asyncio is not available")
+class TestAsyncioZeroCopy(TestAsyncioTransport):
+    BUILDER = asyncio_transport.Builder(zero_copy=True, bin_view_threshold=1024) if asyncio_transport else None
+
+    def test_bin_view(self):
+        client = self.setup_env();
+
+        self.assertEqual(client.call('bin_info', b'x' * 10), ['bytes', 10])
+        self.assertEqual(client.call('bin_info', b'x' * (1 << 20)), ['memoryview', 1 << 20])
+        self.assertEqual(client.call('sum', 1, 2), 3)
+
+
+class TestUnixTransport(TestMessagePackRPC):
+    BUILDER = unix
+
+    def setUp(self):
+        import tempfile
+        self._dir = tempfile.mkdtemp()
+        self._address = msgpackrpc.UnixAddress(os.path.join(self._dir, 'rpc.sock'))
+
+    def tearDown(self):
+        TestMessagePackRPC.tearDown(self)
+        self.assertFalse(os.path.exists(self._address.path))
+        os.rmdir(self._dir)
+
+    def test_connect_failed(self):
+        client = self.setup_env();
+        client = msgpackrpc.Client(os.path.join(self._dir, 'missing.sock'), builder=self.BUILDER)
+        self.assertRaises(error.TransportError, lambda: client.call('hello'))
+
+
+class TestShmTransport(TestUnixTransport):
+    BUILDER = shm.Builder(threshold=1024)
+
+    def segments(self):
+        return set(name for name in os.listdir(shm.SHM_DIR) if name.startswith(shm.PREFIX))
+
+    def test_shared_memory(self):
+        client = self.setup_env();
+        before = self.segments()
+
+        self.assertEqual(client.call('bin_info', b'x' * 10), ['bytes', 10])
+        self.assertEqual(client.call('bin_info', b'x' * (1 << 20)), ['memoryview', 1 << 20])
+        self.assertEqual(client.call('bin_info', [{'data': bytearray(4096)}])[1], 1)
+
+        buf = shm.Buffer(4096)
+        buf.view[:] = b'y' * 4096
+        self.assertEqual(client.call('bin_info', buf), ['memoryview', 4096])
+
+        result = client.call('zeros', 1 << 16)
+        self.assertIsInstance(result, memoryview)
+        self.assertEqual(bytes(result), b'\0' * (1 << 16))
+        self.assertEqual(self.segments(), before)
+
+
+@unittest.skipIf(not os.uname()[0] == 'Linux', "abstract namespace is Linux only")
+class TestUnixAbstractTransport(TestMessagePackRPC):
+    BUILDER = unix
+
+    def setUp(self):
+        self._address = msgpackrpc.UnixAddress('@msgpackrpc-test-{0}-{1}'.format(os.getpid(), self.id()))
+
+    def test_connect_failed(self):
+        client = self.setup_env();
+        client = msgpackrpc.Client('@msgpackrpc-missing', builder=self.BUILDER)
+        self.assertRaises(error.TransportError, lambda: client.call('hello'))
+
+
+class TestMemoryTransport(TestMessagePackRPC):
+    BUILDER = memory
+
+
+class TestFraming(unittest.TestCase):
+    OBJECTS = [None, True, 0, -33, 1 << 40, 1.5, "x" * 40, b"b" * 300,
+               [1, [2, [3]], {b"a": b"q" * 5000}], msgpack.ExtType(5, b"abc")]
+
+    def test_receive_buffer(self):
+        data = b''.join(msgpack.packb(obj, use_bin_type=True) for obj in self.OBJECTS)
+        buf = ReceiveBuffer(encoding='utf-8', bin_view_threshold=1000)
+
+        messages = []
+        for i in range(0, len(data), 7):
+            chunk = data[i:i + 7]
+            buf.get_buffer(-1)[:len(chunk)] = chunk
+            buf.buffer_updated(len(chunk))
+            messages.extend(buf.messages())
+
+        self.assertTrue(isinstance(messages[8][2][b"a"], memoryview))
+        messages[8][2][b"a"] = messages[8][2][b"a"].tobytes()
+        self.assertEqual(messages, self.OBJECTS)
+
+    def test_frame_size(self):
+        data = msgpack.packb([1, b"x" * 100, {b"k": [None]}], use_bin_type=True)
+        self.assertEqual(frame_size(data, 0, len(data)), (len(data), False))
+        self.assertEqual(frame_size(data, 0, len(data), 100), (len(data), True))
+        self.assertEqual(frame_size(data, 0, 5)[0], None)
+
+
+class TestPoolTransport(TestMessagePackRPC):
+    BUILDER = pool.Builder(size=3)
+
+    def test_balance(self):
+        client = self.setup_env();
+
+        futures = [client.call_async('sum', i, 1) for i in range(30)]
+        self.assertEqual([future.get() for future in futures], list(range(1, 31)))
+        self.assertEqual(len(client._transport._members), 3)
+        self.assertTrue(all(member.connected for member in client._transport._members))
+
+    def test_dead_replica(self):
+        self.setup_env();
+
+        dead = msgpackrpc.Address('localhost', helper.unused_port())
+        builder = pool.Builder(size=2, balancer=pool.LEAST_OUTSTANDING, reconnect_interval=60)
+        client = msgpackrpc.Client([self._address, dead], builder=builder, unpack_encoding='utf-8')
+        try:
+            for i in range(20):
+                self.assertEqual(client.call('sum', i, 1), i + 1)
+            self.assertEqual(set(member.address for member in client._transport._members), set([self._address]))
+        finally:
+            client.close()
+
+
+@unittest.skipIf(not hasattr(os, 'fork'), "fork is not available")
+class TestPrefork(unittest.TestCase):
+    def setUp(self):
+        self._address = msgpackrpc.Address('localhost', helper.unused_port())
+        self._supervisor = os.fork()
+        if self._supervisor == 0:
+            try:
+                server = msgpackrpc.Server(TestMessagePackRPC.TestServer())
+                server.listen(self._address)
+                server.start(workers=1, grace_period=0)
+            finally:
+                os._exit(0)
+
+    def tearDown(self):
+        os.kill(self._supervisor, signal.SIGTERM)
+        os.waitpid(self._supervisor, 0)
+
+    def worker_pid(self, exclude=None):
+        deadline = time() + 10
+        while time() < deadline:
+            client = msgpackrpc.Client(self._address, timeout=1)
+            try:
+                pid = client.call('pid')
+                if pid != exclude:
+                    return pid
+            except error.RPCError:
+                pass
+            finally:
+                client.close()
+            sleep(0.1)
+        self.fail("no worker is serving")
+
+    def test_respawn_and_reload(self):
+        pid = self.worker_pid()
+        self.assertNotEqual(pid, self._supervisor)
+
+        client = msgpackrpc.Client(self._address)
+        client.notify('crash')
+        client.close()
+        respawned = self.worker_pid(exclude=pid)
+
+        os.kill(self._supervisor, signal.SIGHUP)
+        self.assertNotEqual(self.worker_pid(exclude=respawned), respawned)
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_expire(self):
+        wheel = TimerWheel(tick=0.1, slots=8)
+        wheel.arm(1, 0.25)
+        wheel.arm(2, 0.5)
+        wheel.arm(3, 2.0)   # longer than one revolution
+
+        self.assertEqual(wheel.advance(0.2), [])
+        self.assertEqual(wheel.advance(0.35), [1])
+        self.assertEqual(wheel.advance(1.05), [2])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(2.05), [3])
+        self.assertEqual(len(wheel), 0)
+
+    def test_cancel(self):
+        wheel = TimerWheel(tick=0.1, slots=8)
+        wheel.arm(1, 0.1)
+        wheel.arm(2, 0.1)
+        wheel.cancel(1)
+        wheel.cancel(3)
+
+        self.assertFalse(1 in wheel)
+        self.assertEqual(wheel.advance(10.0), [2])
+
+
+class TestSerializer(unittest.TestCase):
+    class Point(object):
+        def __init__(self, x, y):
+            self.x = x
+            self.y = y
+
+    def roundtrip(self, registry, value):
+        packed = msgpack.packb(value, default=registry.default)
+        return msgpack.unpackb(packed, ext_hook=registry.ext_hook)
+
+    def test_register(self):
+        registry = serializer.Registry()
+        registry.register(self.Point, 16, lambda p: msgpack.packb([p.x, p.y]),
+                          lambda data: self.Point(*msgpack.unpackb(data)))
+
+        class Point3(self.Point):
+            pass
+
+        point = self.roundtrip(registry, [Point3(1, 2)])[0]
+        self.assertEqual((type(point), point.x, point.y), (self.Point, 1, 2))
+        self.assertEqual(self.roundtrip(registry, msgpack.ExtType(17, b'x')), msgpack.ExtType(17, b'x'))
+        self.assertRaises(ValueError, lambda: registry.register(self.Point, 128, None, None))
+
+    def test_datetime(self):
+        registry = serializer.REGISTRY
+        for value in [datetime.datetime(1970, 1, 1, 0, 1), datetime.datetime(2020, 1, 2, 3, 4, 5, 6),
+                      datetime.datetime(1960, 1, 1, 0, 0, 0, 5), datetime.datetime(2600, 1, 1)]:
+            self.assertEqual(self.roundtrip(registry, value), value)
+            aware = value.replace(tzinfo=serializer._UTC)
+            self.assertEqual(self.roundtrip(registry, aware), aware)
+        # 32 bit layout for whole seconds
+        self.assertEqual(len(msgpack.packb(datetime.datetime(2020, 1, 1), default=registry.default)), 6)
+
+    @unittest.skipIf(serializer.numpy is None, "numpy is not installed")
+    def test_ndarray(self):
+        numpy = serializer.numpy
+        array = numpy.arange(12, dtype='<f8').reshape(3, 4)
+        for value in [array, array.T, array.astype('>i2')]:
+            decoded = self.roundtrip(serializer.REGISTRY, value)
+            self.assertEqual((decoded.dtype, decoded.shape), (value.dtype, value.shape))
+            self.assertTrue((decoded == value).all())
+
+
+class TestResultCache(unittest.TestCase):
+    def fill(self, cache, key, result):
+        self.assertEqual(cache.fetch(key)[0], 'miss')
+        cache.complete(key, result)
+
+    def test_lru(self):
+        cache = ResultCache(['get'], max_bytes=100)
+        keys = [cache.key('get', [i]) for i in range(4)]
+        for key in keys[:3]:
+            self.fill(cache, key, b'x' * 20)
+        self.assertEqual(cache.fetch(keys[0]), ('hit', b'x' * 20))
+
+        # Evicts the least recently used
+        self.fill(cache, keys[3], b'y' * 20)
+        self.assertEqual([cache.fetch(key)[0] for key in keys], ['hit', 'miss', 'hit', 'hit'])
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertTrue(cache.stats()['bytes'] <= 100)
+
+        # Too large to be cached at all
+        cache.complete(keys[1], b'z' * 200)
+        self.assertEqual(cache.fetch(keys[1])[0], 'miss')
+        self.assertEqual(cache.key('put', [1]), None)
+
+    def test_ttl_and_errors(self):
+        cache = ResultCache({'get': 0.1, 'list': None}, ttl=10)
+        key = cache.key('get', [1])
+        self.fill(cache, key, 'value')
+        self.assertEqual(cache.fetch(key), ('hit', 'value'))
+        sleep(0.15)
+        self.assertEqual(cache.fetch(key)[0], 'miss')
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+        waited = []
+        self.assertEqual(cache.fetch(key)[0], 'pending')
+        cache.wait(key, lambda result, error: waited.append((result, error)))
+        cache.complete(key, None, 'failed')
+        self.assertEqual(waited, [(None, 'failed')])
+        self.assertEqual(cache.fetch(key)[0], 'miss')
+
+    def test_invalidate_in_flight(self):
+        cache = ResultCache(['get'])
+        key = cache.key('get', [1])
+        self.assertEqual(cache.fetch(key)[0], 'miss')
+        cache.invalidate('get')
+        cache.complete(key, 'old')
+        self.assertEqual(cache.fetch(key)[0], 'miss')
+
+
+class TestIDGenerator(unittest.TestCase):
+    def test_threads(self):
+        generator = msgpackrpc.session._IDGenerator()
+        ids = []
+        def take():
+            ids.extend([next(generator) for _ in range(10000)])
+        threads = [threading.Thread(target=take) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(ids), list(range(40000)))
+
+
+class TestHistogram(unittest.TestCase):
+    def test_percentile(self):
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(50), None)
+        for i in range(1, 1001):
+            histogram.record(i / 1000.0)
+
+        self.assertEqual(histogram.count, 1000)
+        self.assertEqual(histogram.max, 1.0)
+        for p, expected in ((50, 0.5), (99, 0.99), (99.9, 0.999), (100, 1.0)):
+            self.assertTrue(abs(histogram.percentile(p) - expected) <= expected / 16, (p, histogram.percentile(p)))
+
+    def test_buckets(self):
+        from msgpackrpc.metrics import _bucket, _upper
+        previous = -1
+        for value in range(0, 100000, 7):
+            index = _bucket(value, 4)
+            self.assertTrue(index >= previous)
+            self.assertTrue(_upper(index, 4) >= value)
+            self.assertTrue(index == 0 or _upper(index - 1, 4) < value)
+            previous = index
+
+
+class TestBench(unittest.TestCase):
+    def test_percentile(self):
+        samples = list(range(1, 1001))
+        self.assertEqual(bench.percentile(samples, 50), 500)
+        self.assertEqual(bench.percentile(samples, 99), 990)
+        self.assertEqual(bench.percentile(samples, 99.9), 999)
+        self.assertEqual(bench.percentile([], 50), None)
+
+    def test_sweep_and_compare(self):
+        results = bench.sweep(['tcp'], [1], [0, 1024], [4], 0.2)
+        self.assertEqual([(r['payload'], r['errors']) for r in results], [(0, 0), (1024, 0)])
+        self.assertTrue(all(r['requests'] > 0 and r['latency_ms']['p99'] > 0 for r in results))
+
+        baseline = {'results': [dict(results[0], throughput=results[0]['throughput'] * 2)]}
+        self.assertEqual(bench.compare(results, baseline, 0.1), [(results[0], baseline['results'][0])])
+        self.assertEqual(bench.compare(results, {'results': results}, 0.1), [])
+
+
 if __name__ == '__main__':
     import sys
 